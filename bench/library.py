@@ -0,0 +1,241 @@
+"""Make a fake music library to benchmark zipls against.
+
+The songs are small but real mp3, ogg vorbis and flac files, with
+title, artist, album and track number tags that mutagen can read, and
+an ARTIST/ALBUM/NN - TITLE.EXT layout. There's no actual sound in them,
+just enough of a stream for mutagen to work out a length, and then
+padding to make them about as big as you asked for.
+
+Every song also goes into library.pls, library.m3u and library.xspf in
+the root of the library.
+
+    python bench/library.py --songs 10000 /tmp/library
+"""
+
+from __future__ import with_statement
+
+import argparse
+import os
+import random
+import struct
+import urllib
+from xml.sax.saxutils import escape
+
+FORMATS = ('mp3', 'ogg', 'flac')
+SONGS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 4
+SAMPLE_RATE = 44100
+DEFAULT_SONG_SIZE = 64 << 10
+WORDS = ("love", "night", "blue", "fire", "heart", "road", "rain",
+         "dance", "gold", "river", "ghost", "summer", "electric",
+         "lonely", "song", "city", "dream", "wild", "echo", "stone")
+
+################################################################
+# mp3: an ID3v2.3 tag, a Xing frame that says how many frames there
+# are, and some silent MPEG-1 layer III frames (which there are fewer
+# of than that)
+
+# 128kbit/s, 44.1kHz, stereo, no CRC: 417 bytes a frame, 1152 samples
+_MP3_HEADER = '\xff\xfb\x90\x00'
+_MP3_FRAME = _MP3_HEADER + '\x00' * (417 - len(_MP3_HEADER))
+# the Xing tag goes after the 32 bytes of stereo side information
+_XING_OFFSET = len(_MP3_HEADER) + 32
+
+def _synchsafe(n):
+    return struct.pack('>4B', (n >> 21) & 0x7f, (n >> 14) & 0x7f,
+                       (n >> 7) & 0x7f, n & 0x7f)
+
+def _id3_frame(frame_id, text):
+    # encoding 3 is utf-8, which v2.3 doesn't officially have, so
+    # use latin-1 (0) when we can
+    try:
+        data = '\x00' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        data = '\x01' + text.encode('utf-16')
+    return frame_id + struct.pack('>IH', len(data), 0) + data
+
+def mp3(tags, seconds, size=DEFAULT_SONG_SIZE):
+    frames = ''.join(_id3_frame(frame_id, tags[tag])
+                     for frame_id, tag in (('TIT2', 'title'),
+                                           ('TPE1', 'artist'),
+                                           ('TALB', 'album'),
+                                           ('TRCK', 'track_number')))
+    tag = 'ID3\x03\x00\x00' + _synchsafe(len(frames)) + frames
+    xing = (_MP3_FRAME[:_XING_OFFSET] +
+            'Xing' + struct.pack('>II', 1, seconds * SAMPLE_RATE // 1152))
+    xing += '\x00' * (len(_MP3_FRAME) - len(xing))
+    count = max(1, (size - len(tag)) // len(_MP3_FRAME) - 1)
+    return tag + xing + _MP3_FRAME * count
+
+################################################################
+# flac: STREAMINFO and VORBIS_COMMENT blocks, and no frames at all
+
+def _vorbis_comments(tags):
+    comments = [('%s=%s' % (key.upper(), tags[tag])).encode('utf-8')
+                for key, tag in (('title', 'title'),
+                                 ('artist', 'artist'),
+                                 ('album', 'album'),
+                                 ('tracknumber', 'track_number'))]
+    vendor = 'zipls benchmark'
+    return (struct.pack('<I', len(vendor)) + vendor +
+            struct.pack('<I', len(comments)) +
+            ''.join(struct.pack('<I', len(c)) + c for c in comments))
+
+def flac(tags, seconds, size=DEFAULT_SONG_SIZE):
+    samples = seconds * SAMPLE_RATE
+    # 20 bits of sample rate, 3 of channels - 1, 5 of bits per
+    # sample - 1, then 36 of total samples
+    packed = (SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | samples
+    streaminfo = (struct.pack('>HH', 4096, 4096) + '\x00' * 6 +
+                  struct.pack('>Q', packed) + '\x00' * 16)
+    comments = _vorbis_comments(tags)
+    padding = '\x00' * max(0, size - len(streaminfo) - len(comments) - 16)
+    return ('fLaC' +
+            '\x00' + struct.pack('>I', len(streaminfo))[1:] + streaminfo +
+            '\x04' + struct.pack('>I', len(comments))[1:] + comments +
+            chr(0x80 | 1) + struct.pack('>I', len(padding))[1:] + padding)
+
+################################################################
+# ogg vorbis: identification and comment headers, a setup header that
+# only mutagen would believe, pages of nothing, and a last page to say
+# how long it is
+
+def _ogg_crc_table():
+    table = list()
+    for i in range(256):
+        crc = i << 24
+        for bit in range(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ 0x04c11db7) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+_OGG_CRC = _ogg_crc_table()
+
+def _ogg_page(packets, granule, sequence, flags=0, serial=0x7a6c73):
+    lacing = ''
+    for packet in packets:
+        lacing += '\xff' * (len(packet) // 255) + chr(len(packet) % 255)
+    page = ('OggS\x00' + chr(flags) +
+            struct.pack('<qIII', granule, serial, sequence, 0) +
+            chr(len(lacing)) + lacing + ''.join(packets))
+    crc = 0
+    for byte in page:
+        crc = ((crc << 8) & 0xffffffff) ^ _OGG_CRC[(crc >> 24) ^ ord(byte)]
+    return page[:22] + struct.pack('<I', crc) + page[26:]
+
+def ogg(tags, seconds, size=DEFAULT_SONG_SIZE):
+    ident = ('\x01vorbis' + struct.pack('<IBIiii', 0, 2, SAMPLE_RATE,
+                                         0, 128000, 0) + '\xb8\x01')
+    comment = '\x03vorbis' + _vorbis_comments(tags) + '\x01'
+    setup = '\x05vorbis' + '\x00' * 32
+    pages = [_ogg_page([ident], 0, 0, flags=0x02),
+             _ogg_page([comment, setup], 0, 1)]
+    left = size - sum(len(page) for page in pages)
+    # 250 * 255 byte packets fit in a page with room to spare
+    packet = '\x00' * (250 * 255 - 1)
+    while left > len(packet):
+        pages.append(_ogg_page([packet], 0, len(pages)))
+        left -= len(pages[-1])
+    pages.append(_ogg_page(['\x00' * max(1, left - 64)],
+                           seconds * SAMPLE_RATE, len(pages), flags=0x04))
+    return ''.join(pages)
+
+WRITERS = {'mp3': mp3, 'ogg': ogg, 'flac': flac}
+
+################################################################
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for i in range(count)).title()
+
+def generate(root, songs=1000, formats=FORMATS, seed=0,
+             size=DEFAULT_SONG_SIZE, max_seconds=300):
+    """Write `songs` songs and three playlists of them under `root`.
+
+    `size`: about how big each song should be, in bytes.
+
+    Returns a list of the songs' paths, in playlist order.
+    """
+    rng = random.Random(seed)
+    paths = list()
+    entries = list()
+    artist = album = None
+    for i in range(songs):
+        track = i % SONGS_PER_ALBUM + 1
+        if track == 1:
+            if i % (SONGS_PER_ALBUM * ALBUMS_PER_ARTIST) == 0:
+                artist = u"%s %d" % (_words(rng, 2), i)
+            album = _words(rng, 3)
+            album_dir = os.path.join(root, artist.encode('utf-8'),
+                                     album.encode('utf-8'))
+            if not os.path.isdir(album_dir):
+                os.makedirs(album_dir)
+        title = _words(rng, rng.randint(1, 4))
+        tags = dict(title=title, artist=artist, album=album,
+                    track_number=unicode(track))
+        ext = formats[i % len(formats)]
+        seconds = rng.randint(1, max_seconds)
+        relpath = os.path.join(artist.encode('utf-8'), album.encode('utf-8'),
+                               "%02d - %s.%s" % (track, title.encode('utf-8'),
+                                                 ext))
+        with open(os.path.join(root, relpath), 'wb') as fh:
+            fh.write(WRITERS[ext](tags, seconds, size))
+        paths.append(os.path.join(root, relpath))
+        entries.append((relpath, tags, seconds))
+    write_playlists(root, entries)
+    return paths
+
+def write_playlists(root, entries):
+    "Write library.{pls,m3u,xspf} in `root` for (relpath, tags, seconds)s"
+    with open(os.path.join(root, 'library.pls'), 'w') as fh:
+        fh.write("[playlist]\n")
+        for i, (relpath, tags, seconds) in enumerate(entries):
+            fh.write("File%d=%s\nTitle%d=%s\nLength%d=%d\n\n"
+                     % (i + 1, relpath, i + 1, tags['title'].encode('utf-8'),
+                        i + 1, seconds))
+        fh.write("NumberOfEntries=%d\nVersion=2\n" % len(entries))
+    with open(os.path.join(root, 'library.m3u'), 'w') as fh:
+        fh.write("#EXTM3U\n")
+        for relpath, tags, seconds in entries:
+            fh.write("#EXTINF:%d,%s - %s\n%s\n"
+                     % (seconds, tags['artist'].encode('utf-8'),
+                        tags['title'].encode('utf-8'), relpath))
+    with open(os.path.join(root, 'library.xspf'), 'w') as fh:
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+                 '  <trackList>\n')
+        for relpath, tags, seconds in entries:
+            fh.write('    <track>\n'
+                     '      <location>%s</location>\n'
+                     '      <title>%s</title>\n'
+                     '      <creator>%s</creator>\n'
+                     '      <duration>%d</duration>\n'
+                     '    </track>\n'
+                     % (escape(urllib.quote(relpath)),
+                        escape(tags['title'].encode('utf-8')),
+                        escape(tags['artist'].encode('utf-8')),
+                        seconds * 1000))
+        fh.write('  </trackList>\n'
+                 '</playlist>\n')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make a fake, tagged, music library.")
+    parser.add_argument('root', help="Where to put it.")
+    parser.add_argument('-n', '--songs', type=int, default=1000,
+                        help="How many songs. (Default: %(default)s)")
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help="Which kinds of file, in turn. (Default: %(default)s)")
+    parser.add_argument('--size', type=int, default=DEFAULT_SONG_SIZE >> 10,
+                        metavar='KB',
+                        help="About how big each song is. (Default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="The same seed makes the same library.")
+    args = parser.parse_args()
+    generate(args.root, args.songs, args.formats.split(','), args.seed,
+             args.size << 10)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Time the things zipls does to a fake library from library.py.
+
+    python bench/run.py --songs 5000 --jobs 4 --output results.json
+
+The report is JSON: a bit about the setup, then for each benchmark how
+long it took (the best of --repeat runs), how many songs and bytes per
+second that is, and the peak RSS of the process by the time it was
+done. Compare two of them to see whether a change made things faster.
+"""
+
+from __future__ import with_statement
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+
+import library
+from zipls.zipls import MUTAGEN, VERSION, Songs
+
+FMT = "{track_number:02} - {artist} - {title}.{ext}"
+
+def peak_rss_kb():
+    "The most memory this process (and any children) has used, in KB"
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        # bytes, not KB
+        peak //= 1024
+    return peak
+
+class Bench(object):
+    "Runs benchmarks and collects their results"
+    def __init__(self, repeat=1, quiet=True):
+        self.repeat = repeat
+        self.quiet = quiet
+        self.results = list()
+
+    def time(self, name, func, setup=None, items=None, size=None):
+        """Time `func()`, calling `setup()` (untimed) before each run.
+
+        `items`, `size`: how many songs, and bytes, one run deals with.
+        """
+        best = None
+        for i in range(self.repeat):
+            if setup is not None:
+                setup()
+            stderr = sys.stderr
+            if self.quiet:
+                sys.stderr = open(os.devnull, 'w')
+            try:
+                start = time.time()
+                func()
+                elapsed = time.time() - start
+            finally:
+                if self.quiet:
+                    sys.stderr.close()
+                    sys.stderr = stderr
+            if best is None or elapsed < best:
+                best = elapsed
+
+        result = dict(name=name, seconds=round(best, 6),
+                      peak_rss_kb=peak_rss_kb())
+        if items is not None:
+            result['items'] = items
+            result['items_per_second'] = round(items / best, 2) if best else None
+        if size is not None:
+            result['bytes'] = size
+            result['mb_per_second'] = (round(size / best / (1 << 20), 2)
+                                       if best else None)
+        self.results.append(result)
+        print >>sys.stderr, "%-12s %8.3fs" % (name, best)
+        return result
+
+def _clear(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def run(root, work, bench, jobs=1):
+    """Run every benchmark on the library in `root`, using `work` for
+    output.
+
+    Returns how many songs there are, and how many bytes.
+    """
+    playlists = dict((ext, os.path.join(root, 'library.' + ext))
+                     for ext in ('pls', 'm3u', 'xspf'))
+    songs = Songs(playlists['m3u'])
+    count = len(songs)
+    size = sum(os.path.getsize(song.path) for song in songs)
+
+    for ext in ('pls', 'm3u', 'xspf'):
+        bench.time('parse_' + ext,
+                   lambda: Songs(playlists[ext], jobs=jobs),
+                   items=count)
+
+    # the playlists don't have albums, so asking for them reads tags.
+    # With more than one job that happens while the songs are built,
+    # so time both.
+    state = dict()
+    def read_tags():
+        state['songs'] = Songs(playlists['m3u'], jobs=jobs)
+        for song in state['songs']:
+            song.album
+    bench.time('read_tags', read_tags, items=count)
+
+    songs = state['songs']
+    def format_all():
+        for song in songs:
+            format(song, FMT)
+    bench.time('format', format_all, items=count)
+    for ext in ('pls', 'm3u', 'xspf'):
+        bench.time('to_' + ext, getattr(songs, 'to_' + ext), items=count)
+
+    target = os.path.join(work, 'songs.zip')
+    bench.time('zip_em', lambda: songs.zip_em(target, fmt=FMT),
+               setup=lambda: _clear(target), items=count, size=size)
+    _clear(target)
+
+    target = os.path.join(work, 'copy')
+    bench.time('copy_em', lambda: songs.copy_em(target, fmt=FMT),
+               setup=lambda: _clear(target), items=count, size=size)
+
+    # rename a copy of the library, with its tags already read
+    copy = os.path.join(work, 'rename')
+    def copy_library():
+        _clear(copy)
+        shutil.copytree(root, copy)
+        state['songs'] = Songs(os.path.join(copy, 'library.m3u'), jobs=jobs)
+        for song in state['songs']:
+            song.album
+    bench.time('rename_em',
+               lambda: state['songs'].rename_em(
+                   fmt="{artist} - {album} - {track_number:02} - {title}.{ext}"),
+               setup=copy_library, items=count)
+    return count, size
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark zipls against a fake library.")
+    parser.add_argument('-n', '--songs', type=int, default=1000,
+                        help="How big a library to make. (Default: %(default)s)")
+    parser.add_argument('--size', type=int,
+                        default=library.DEFAULT_SONG_SIZE >> 10, metavar='KB',
+                        help="About how big each song is. (Default: %(default)s)")
+    parser.add_argument('--library', metavar='DIR', default=None,
+                        help="Use (or make, if it isn't there) the library in DIR\n"
+                        "instead of a temporary one.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="--jobs for zipls. (Default: %(default)s)")
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help="Run everything this many times and keep the best.")
+    parser.add_argument('-o', '--output', metavar='PATH', default=None,
+                        help="Write the report to PATH instead of stdout.")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="Let zipls print what it's doing.")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='zipls-bench-')
+    try:
+        root = args.library
+        if root is None:
+            root = os.path.join(work, 'library')
+        if not os.path.exists(os.path.join(root, 'library.m3u')):
+            print >>sys.stderr, "making %d songs in %s" % (args.songs, root)
+            library.generate(root, args.songs, size=args.size << 10)
+        bench = Bench(args.repeat, quiet=not args.verbose)
+        count, size = run(root, work, bench, args.jobs)
+    finally:
+        shutil.rmtree(work)
+
+    report = dict(zipls=VERSION,
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  mutagen=MUTAGEN,
+                  songs=count,
+                  library_bytes=size,
+                  jobs=args.jobs,
+                  repeat=args.repeat,
+                  results=bench.results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import unittest
+
+from zipls import batch
+from zipls.batch import ManifestError
+
+class JobsFromTest(unittest.TestCase):
+    def job(self, **values):
+        "The one job of a manifest that's `values` plus a playlist"
+        return batch.jobs_from({'defaults': {'playlist': u'a.m3u'},
+                                'jobs': [{}, values]})[1]
+
+    def assertBad(self, **values):
+        try:
+            self.job(**values)
+        except ManifestError, e:
+            self.assertTrue(str(e).startswith("job 2's "), str(e))
+        else:
+            self.fail("%r was allowed" % values)
+
+    def test_max_size(self):
+        self.assertEqual(self.job(max_size=u'700M')['max_size'], 700 << 20)
+        self.assertEqual(self.job(max_size=1000)['max_size'], 1000)
+        for size in (u'lots', u'-1k', 0, True, 1.5, [1]):
+            self.assertBad(max_size=size)
+
+    def test_flags(self):
+        for key in batch.FLAGS:
+            self.assertEqual(self.job(**{key: True})[key], True)
+            self.assertBad(**{key: u'false'})
+            self.assertBad(**{key: 1})
+
+    def test_choices(self):
+        self.assertEqual(self.job(export_type=u'xspf')['export_type'],
+                         'xspf')
+        self.assertEqual(self.job(dedupe=u'content')['dedupe'], 'content')
+        self.assertBad(export_type=u'zip')
+        self.assertBad(dedupe=u'yes')
+        self.assertBad(dedupe=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'bench'))
+
+import library
+from zipls.progress import Cancelled, Progress
+from zipls import transfer
+from zipls.zipls import MUTAGEN, Songs
+
+class PruneTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        tags = dict(title=u'Caf\xe9', artist=u'Somebody', album=u'Album',
+                    track_number=u'1')
+        with open(os.path.join(self.dir, 'song.mp3'), 'wb') as fh:
+            fh.write(library.mp3(tags, 60, 4096))
+        self.playlist = os.path.join(self.dir, 'list.m3u')
+        with open(self.playlist, 'w') as fh:
+            fh.write('song.mp3\n')
+        self.target = os.path.join(self.dir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_prune_keeps_non_ascii_songs(self):
+        if not MUTAGEN:
+            self.skipTest("needs mutagen, to read the title")
+        try:
+            u'Caf\xe9'.encode(sys.getfilesystemencoding() or 'ascii')
+        except UnicodeError:
+            self.skipTest("the filesystem encoding can't do non-ascii names")
+        songs = Songs(self.playlist, export_type='none')
+        summary = songs.copy_em(self.target, "{title}.{ext}", prune=True)
+        self.assertFalse('removed' in summary.files)
+        self.assertEqual(os.listdir(self.target), ['Caf\xc3\xa9.mp3'])
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        self.root = os.path.join(self.dir, 'library')
+        library.generate(self.root, 24, size=64 << 10)
+        self.target = os.path.join(self.dir, 'out')
+        # slow enough that there are copies going when it's cancelled
+        self.transfer = transfer.transfer
+        self.going = 0
+        def slow_transfer(*args, **kwargs):
+            self.going += 1
+            try:
+                time.sleep(0.2)
+                return self.transfer(*args, **kwargs)
+            finally:
+                self.going -= 1
+        transfer.transfer = slow_transfer
+
+    def tearDown(self):
+        transfer.transfer = self.transfer
+        shutil.rmtree(self.dir)
+
+    def test_cancelled_copies_leave_nothing_behind(self):
+        def cancel(progress):
+            if progress.items_done >= 1:
+                progress.cancel()
+        songs = Songs(os.path.join(self.root, 'library.m3u'),
+                      export_type='none', jobs=8,
+                      progress=Progress(cancel))
+        self.assertRaises(Cancelled, songs.copy_em, self.target,
+                          strategy='copy')
+        self.assertEqual(self.going, 0)
+        self.assertFalse(os.path.exists(self.target))
+
+    def copy_failing(self, songs, fmt):
+        "Return what `songs.copy_em` raises, as long as it doesn't hang"
+        raised = list()
+        def copy():
+            try:
+                songs.copy_em(self.target, fmt, strategy='copy')
+            except Exception, e:
+                raised.append(e)
+        thread = threading.Thread(target=copy)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "copy_em hung")
+        self.assertEqual(len(raised), 1)
+        return raised[0]
+
+    def test_songs_that_cant_be_named(self):
+        songs = Songs(os.path.join(self.root, 'library.m3u'),
+                      export_type='none', jobs=2)
+        # titles aren't numbers
+        self.assertTrue(isinstance(self.copy_failing(songs, "{title:d}.{ext}"),
+                                   ValueError))
+
+    def test_playlist_that_isnt_there(self):
+        songs = Songs([os.path.join(self.root, 'library.m3u'),
+                       os.path.join(self.root, 'nope.m3u')],
+                      export_type='none', jobs=2, lazy=True)
+        self.assertTrue(isinstance(self.copy_failing(songs, "{title}.{ext}"),
+                                   EnvironmentError))
+
+    def test_failed_export_leaves_nothing_behind(self):
+        songs = Songs([os.path.join(self.root, 'library.m3u'),
+                       os.path.join(self.root, 'nope.m3u')],
+                      export_type='none', lazy=True)
+        zipped = os.path.join(self.dir, 'out.zip')
+        manifest = os.path.join(self.dir, 'out.sha1')
+        self.assertRaises(EnvironmentError, songs.export, zipped,
+                          self.target, manifest, "{title}.{ext}")
+        for path in (zipped, self.target, manifest):
+            self.assertFalse(os.path.exists(path), path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from zipls.zipls import FormatError, Song, compile_format
+
+class GenreSong(Song):
+    "Sets its extra tag on each song, without declaring it"
+    def __init__(self, path, genre=None, **kwargs):
+        Song.__init__(self, path, **kwargs)
+        self.genre = genre
+
+class SlottedGenreSong(Song):
+    __slots__ = ('genre',)
+
+    def __init__(self, path, genre=None, **kwargs):
+        Song.__init__(self, path, **kwargs)
+        self.genre = genre
+
+class CompileFormatTest(unittest.TestCase):
+    def test_unknown_tag(self):
+        self.assertRaises(FormatError, compile_format, "{genre}.{ext}")
+
+    def test_tag_set_on_songs(self):
+        fmt = compile_format("{genre} - {title}.{ext}", GenreSong)
+        song = GenreSong('song.mp3', genre='Polka', title='Beer',
+                         exists=True)
+        self.assertEqual(fmt.render(song), 'Polka - Beer.mp3')
+
+    def test_tag_in_slots(self):
+        fmt = compile_format("{genre}.{ext}", SlottedGenreSong)
+        song = SlottedGenreSong('song.mp3', genre='Polka', exists=True)
+        self.assertEqual(fmt.render(song), 'Polka.mp3')
+        self.assertRaises(FormatError, compile_format, "{mood}.{ext}",
+                          SlottedGenreSong)
+
+    def test_unknown_tag_set_on_songs(self):
+        # there's no telling until there's a song
+        fmt = compile_format("{mood}.{ext}", GenreSong)
+        self.assertRaises(FormatError, fmt.render,
+                          GenreSong('song.mp3', exists=True))
+
+if __name__ == '__main__':
+    unittest.main()
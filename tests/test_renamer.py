@@ -0,0 +1,94 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from zipls import renamer
+from zipls.progress import Progress
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        for name in ('a', 'b', 'c', 'd', 'f'):
+            with open(self.path(name), 'w') as fh:
+                fh.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_counts_files_not_steps(self):
+        # a swap goes via a temporary name, and c and f don't move at all
+        moves = [(self.path('a'), self.path('b')),
+                 (self.path('b'), self.path('a')),
+                 (self.path('c'), self.path('c')),
+                 (self.path('d'), self.path('e')),
+                 (self.path('f'), self.path('f'))]
+        self.assertEqual(len(renamer.plan(moves)), 4)
+        progress = Progress()
+        progress.start('rename', len(moves))
+        renamer.rename(moves, progress=progress)
+        self.assertEqual(progress.items_total, 5)
+        self.assertEqual(progress.items_done, 5)
+        for name, was in (('a', 'b'), ('b', 'a'), ('c', 'c'), ('e', 'd')):
+            with open(self.path(name)) as fh:
+                self.assertEqual(fh.read(), was)
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        self.journal = self.path('journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'w') as fh:
+            fh.write(data)
+
+    def read(self, name):
+        with open(self.path(name)) as fh:
+            return fh.read()
+
+    def test_steps_that_happened_but_werent_written_down(self):
+        steps = [(self.path('b'), self.path('c')),
+                 (self.path('a'), self.path('b'))]
+        renamer.Journal.create(self.journal, steps)
+        # both renames happened, but we died before saying so
+        self.write('b', 'a')
+        self.write('c', 'b')
+        renamer.resume(self.journal)
+        self.assertEqual(self.read('b'), 'a')
+        self.assertEqual(self.read('c'), 'b')
+
+    def test_resume_from_somewhere_else(self):
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            renamer.Journal.create(self.journal, [('a', 'b')])
+        finally:
+            os.chdir(cwd)
+        self.write('a', 'a')
+        renamer.resume(self.journal)
+        self.assertEqual(self.read('b'), 'a')
+        self.assertFalse(os.path.exists(self.path('a')))
+
+    def test_never_overwrites(self):
+        steps = [(self.path('a'), self.path('b'))]
+        renamer.Journal.create(self.journal, steps)
+        self.write('a', 'a')
+        self.write('b', 'something else')
+        self.assertRaises(renamer.RenameCollision,
+                          renamer.resume, self.journal)
+        self.assertEqual(self.read('a'), 'a')
+        self.assertEqual(self.read('b'), 'something else')
+
+if __name__ == '__main__':
+    unittest.main()
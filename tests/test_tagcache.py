@@ -0,0 +1,56 @@
+from __future__ import with_statement
+
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from zipls import tagcache
+from zipls.tagcache import TagCache
+
+class TagCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def song(self, name):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fh:
+            fh.write(name)
+        return path
+
+    def test_non_ascii_paths(self):
+        tags = dict(title=u'Caf\xe9', artist=u'Somebody', album=None,
+                    track_number=1, length=60)
+        # utf-8, and bytes that aren't in any encoding in particular
+        paths = [self.song('Caf\xc3\xa9.mp3'), self.song('\xff.mp3')]
+        with TagCache(os.path.join(self.dir, 'tags.sqlite')) as cache:
+            for crc, path in enumerate(paths):
+                self.assertEqual(cache.get(path), None)
+                cache.put(path, tags)
+                cache.put_crc(path, crc)
+        # and they're still there next time
+        with TagCache(os.path.join(self.dir, 'tags.sqlite')) as cache:
+            for crc, path in enumerate(paths):
+                self.assertEqual(cache.get(path), tags)
+                self.assertEqual(cache.get_crc(path), crc)
+
+    def test_closed_at_exit_without_being_kept(self):
+        path = os.path.join(self.dir, 'tags.sqlite')
+        song = self.song('song.mp3')
+        cache = TagCache(path)
+        cache.put_crc(song, 1234)
+        tagcache._close_all()
+        with TagCache(path) as reopened:
+            self.assertEqual(reopened.get_crc(song), 1234)
+        # and ones nobody has any more aren't kept around for it
+        dropped = weakref.ref(TagCache(path))
+        gc.collect()
+        self.assertEqual(dropped(), None)
+
+if __name__ == '__main__':
+    unittest.main()
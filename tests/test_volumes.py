@@ -0,0 +1,42 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'bench'))
+
+import library
+from zipls.tagcache import MemoryTagCache
+from zipls.zipls import Songs
+
+class VolumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        self.root = os.path.join(self.dir, 'library')
+        library.generate(self.root, 6, size=16 << 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_volume_playlists_share_our_state(self):
+        seen = list()
+        class Recording(Songs):
+            def write_m3u(self, *args, **kwargs):
+                seen.append((self.tag_cache, self.progress, self._dirs))
+                return Songs.write_m3u(self, *args, **kwargs)
+        songs = Recording(os.path.join(self.root, 'library.m3u'),
+                          tag_cache=MemoryTagCache())
+        paths = songs.zip_em(os.path.join(self.dir, 'out'),
+                             fmt="{title}.{ext}", max_size=40 << 10)
+        self.assertTrue(len(paths) > 1)
+        self.assertEqual(len(seen), len(paths))
+        for state in seen:
+            self.assertEqual(state, (songs.tag_cache, songs.progress,
+                                     songs._dirs))
+
+if __name__ == '__main__':
+    unittest.main()
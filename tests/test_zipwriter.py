@@ -0,0 +1,236 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+import zlib
+from cStringIO import StringIO
+
+from zipls import zipwriter
+from zipls.zipwriter import ZipWriter, ZIP_DEFLATED, ZIP_STORED
+
+class _Pipe(object):
+    "Somewhere to write a zip file that can't seek, like a pipe"
+    def __init__(self):
+        self.buf = StringIO()
+
+    def write(self, data):
+        self.buf.write(data)
+
+    def flush(self):
+        pass
+
+    def archive(self):
+        "What was written, to read back"
+        return StringIO(self.buf.getvalue())
+
+class Zip64Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        self.limits = zipwriter.ZIP64_LIMIT, zipwriter.ZIP64_COUNT_LIMIT
+
+    def tearDown(self):
+        zipwriter.ZIP64_LIMIT, zipwriter.ZIP64_COUNT_LIMIT = self.limits
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def song(self, name, size):
+        "Make a file of `size` bytes that don't compress to nothing"
+        path = self.path(name)
+        with open(path, 'wb') as fh:
+            fh.write((name * (size // len(name) + 1))[:size])
+        return path
+
+    def assertZip64(self, path, zip64=True):
+        """Check that the archive at `path` has a ZIP64 end record (or
+        that it doesn't)
+        """
+        with open(path, 'rb') as fh:
+            fh.seek(-zipwriter.END_SIZE, os.SEEK_END)
+            self.assertEqual(zipfile.stringEndArchive64Locator in fh.read(),
+                             zip64)
+
+    def check(self, archive, expected):
+        """Check that `archive` (a path or a file) has exactly the
+        members in the dict `expected`, and that they all read back
+        """
+        zf = zipfile.ZipFile(archive)
+        try:
+            self.assertEqual(sorted(zf.namelist()), sorted(expected))
+            self.assertEqual(zf.testzip(), None)
+            for name, data in expected.items():
+                self.assertEqual(zf.read(name), data)
+        finally:
+            zf.close()
+
+    def write_many(self, target, count):
+        expected = dict()
+        zw = ZipWriter(target)
+        for i in range(count):
+            name = 'songs/%06d.mp3' % i
+            expected[name] = str(i)
+            with zw.open(name) as member:
+                member.write(str(i))
+        zw.close()
+        return expected
+
+    def test_more_members_than_fit_in_the_end_record(self):
+        count = zipwriter.MAX_MEMBERS + 2
+        target = self.path('many.zip')
+        expected = self.write_many(target, count)
+        self.assertZip64(target)
+        self.check(target, expected)
+
+        # and it can be updated, staying ZIP64
+        first = 'songs/000000.mp3'
+        zw = ZipWriter.update(target, lambda info: info.filename != first)
+        zw.write(self.song('new.mp3', 100), 'songs/new.mp3')
+        zw.close()
+        del expected[first]
+        expected['songs/new.mp3'] = open(self.path('new.mp3'), 'rb').read()
+        self.assertEqual(len(expected), count)
+        self.assertZip64(target)
+        self.check(target, expected)
+
+    def test_exactly_the_count_limit(self):
+        zipwriter.ZIP64_COUNT_LIMIT = 3
+        for count, zip64 in ((2, False), (3, True)):
+            target = self.path('%d.zip' % count)
+            expected = self.write_many(target, count)
+            self.assertZip64(target, zip64)
+            self.check(target, expected)
+
+    def test_more_members_than_fit_in_the_end_record_streaming(self):
+        pipe = _Pipe()
+        expected = self.write_many(pipe, zipwriter.MAX_MEMBERS + 2)
+        self.check(pipe.archive(), expected)
+
+    def big_members(self, target):
+        """Write members that are over the (lowered) ZIP64 limit every
+        way that there is
+        """
+        zipwriter.ZIP64_LIMIT = 1000
+        zipwriter.ZIP64_COUNT_LIMIT = 3
+        expected = dict()
+        zw = ZipWriter(target)
+        for i, compress_type in enumerate((ZIP_STORED, ZIP_DEFLATED)):
+            path = self.song('%d.wav' % i, 5000)
+            name = 'songs/%d.wav' % i
+            zw.write(path, name, compress_type)
+            expected[name] = open(path, 'rb').read()
+        data = os.urandom(3000)
+        with zw.open('songs/open.wav', ZIP_DEFLATED,
+                     size=len(data)) as member:
+            member.write(data)
+        expected['songs/open.wav'] = data
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        zw.write_deflated('songs/deflated.wav',
+                          (zlib.crc32(data) & 0xffffffff, len(data), deflated))
+        expected['songs/deflated.wav'] = data
+        # past the limit, but not big itself
+        with zw.open('songs/small.txt') as member:
+            member.write('small')
+        expected['songs/small.txt'] = 'small'
+        zw.close()
+        return expected
+
+    def test_big_members(self):
+        target = self.path('big.zip')
+        expected = self.big_members(target)
+        self.assertZip64(target)
+        zf = zipfile.ZipFile(target)
+        self.assertEqual(zf.getinfo('songs/0.wav').file_size, 5000)
+        self.assertTrue(zf.getinfo('songs/small.txt').header_offset >=
+                        zipwriter.ZIP64_LIMIT)
+        zf.close()
+        with open(target, 'rb') as fh:
+            # the local headers' sizes are in their ZIP64 extra fields
+            self.assertEqual(fh.read(30)[18:26], '\xff' * 8)
+        self.check(target, expected)
+
+    def test_big_members_streaming(self):
+        pipe = _Pipe()
+        expected = self.big_members(pipe)
+        self.check(pipe.archive(), expected)
+
+    def test_update_big_members(self):
+        target = self.path('big.zip')
+        expected = self.big_members(target)
+        # drop the first, so that everything after it moves
+        zw = ZipWriter.update(target,
+                              lambda info: info.filename != 'songs/0.wav')
+        path = self.song('more.wav', 4000)
+        zw.write(path, 'songs/more.wav', ZIP_DEFLATED)
+        zw.close()
+        del expected['songs/0.wav']
+        expected['songs/more.wav'] = open(path, 'rb').read()
+        self.assertZip64(target)
+        self.check(target, expected)
+
+    def test_member_that_outgrows_its_header(self):
+        zipwriter.ZIP64_LIMIT = 1000
+        zw = ZipWriter(self.path('grown.zip'))
+        member = zw.open('songs/grown.wav')
+        member.write('x' * 2000)
+        self.assertRaises(zipfile.LargeZipFile, member.close)
+        zw.abort()
+        self.assertFalse(os.path.exists(self.path('grown.zip')))
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='zipls-test-')
+        self.target = os.path.join(self.dir, 'songs.zip')
+        self.expected = dict()
+        zw = ZipWriter(self.target)
+        for i in range(5):
+            name = 'songs/%d.mp3' % i
+            self.expected[name] = name * 100
+            with zw.open(name) as member:
+                member.write(self.expected[name])
+        zw.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_keep_raising_changes_nothing(self):
+        with open(self.target, 'rb') as fh:
+            before = fh.read()
+        def keep(info):
+            if info.filename == 'songs/3.mp3':
+                raise OSError("can't stat it")
+            return info.filename != 'songs/0.mp3'
+        self.assertRaises(OSError, ZipWriter.update, self.target, keep)
+        with open(self.target, 'rb') as fh:
+            self.assertEqual(fh.read(), before)
+
+    def test_failed_move_leaves_what_was_moved(self):
+        move = ZipWriter._move
+        moves = list()
+        def failing_move(zw, start, length):
+            moves.append(start)
+            if len(moves) == 3:
+                zw._write('half a member')
+                raise IOError("disk full")
+            move(zw, start, length)
+        ZipWriter._move = failing_move
+        try:
+            self.assertRaises(IOError, ZipWriter.update, self.target,
+                              lambda info: info.filename != 'songs/0.mp3')
+        finally:
+            ZipWriter._move = move
+        zf = zipfile.ZipFile(self.target)
+        try:
+            self.assertEqual(zf.namelist(), ['songs/1.mp3', 'songs/2.mp3'])
+            self.assertEqual(zf.testzip(), None)
+            for name in zf.namelist():
+                self.assertEqual(zf.read(name), self.expected[name])
+        finally:
+            zf.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Build and export `Songs` from an event loop, without blocking it.
+
+Everything zipls does is blocking file I/O, so this runs it on a pool
+of threads and hands back tasks for the loop to wait on. At most
+`max_workers` things run at once, and the rest wait their turn, so a
+server can take as many requests as it likes without starting as many
+exports.
+
+zipls is python 2, so this needs trollius (`pip install trollius`),
+which is asyncio for python 2:
+
+    >>> exporter = Exporter(max_workers=2)
+    >>> songs = yield From(exporter.songs("playlist.m3u", jobs=4))
+    >>> yield From(exporter.zip_em(songs, "playlist.zip"))
+
+Cancelling one of the tasks cancels the work behind it: it stops at
+the next song, removes what it had written so far, and only then does
+the task finish cancelled. That goes through the songs' `progress` (see
+`progress.Progress.cancel`), so only run one thing at a time with each
+`Songs`.
+"""
+
+from functools import partial
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+from progress import Cancelled, Progress
+from zipls import Songs
+
+class Exporter(object):
+    "Runs zipls on a pool of threads for an event loop"
+    def __init__(self, max_workers=4, loop=None):
+        """`max_workers`: how many things can run at once.
+        `loop`: the event loop, by default the current one.
+        """
+        if asyncio is None:
+            raise RuntimeError("zipls.aio needs trollius and futures: "
+                               "pip install trollius")
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def _run(self, progress, call):
+        """Return a task that runs `call()` on the pool.
+
+        Cancelling it cancels `progress`.
+        """
+        progress.cancelled = False
+        work = self.loop.run_in_executor(self.executor, call)
+        return asyncio.ensure_future(self._wait(work, progress),
+                                     loop=self.loop)
+
+    def _wait(self, work, progress):
+        try:
+            # shielded, so that cancelling us doesn't forget about the
+            # thread, which is still going
+            result = yield From(asyncio.shield(work, loop=self.loop))
+        except asyncio.CancelledError:
+            progress.cancel()
+            # let it notice, and clean up after itself
+            try:
+                yield From(work)
+            except Cancelled:
+                pass
+            # not a bare raise, which would be the Cancelled by now
+            raise asyncio.CancelledError()
+        except Cancelled:
+            # somebody cancelled the progress itself
+            raise asyncio.CancelledError()
+        raise Return(result)
+
+    def songs(self, playlists, **kwargs):
+        """Build `Songs(playlists, **kwargs)`.
+
+        They're all parsed before the task finishes, whatever `lazy`
+        says, so that nothing reads playlists on the loop afterwards.
+        """
+        kwargs['lazy'] = False
+        if kwargs.get('progress') is None:
+            kwargs['progress'] = Progress()
+        return self._run(kwargs['progress'],
+                         partial(Songs, playlists, **kwargs))
+
+    def zip_em(self, songs, *args, **kwargs):
+        "Run `songs.zip_em(*args, **kwargs)`"
+        return self._run(songs.progress,
+                         partial(songs.zip_em, *args, **kwargs))
+
+    def copy_em(self, songs, *args, **kwargs):
+        "Run `songs.copy_em(*args, **kwargs)`"
+        return self._run(songs.progress,
+                         partial(songs.copy_em, *args, **kwargs))
+
+    def export(self, songs, *args, **kwargs):
+        "Run `songs.export(*args, **kwargs)`"
+        return self._run(songs.progress,
+                         partial(songs.export, *args, **kwargs))
+
+    def rename_em(self, songs, *args, **kwargs):
+        "Run `songs.rename_em(*args, **kwargs)`"
+        return self._run(songs.progress,
+                         partial(songs.rename_em, *args, **kwargs))
+
+    def close(self, wait=True):
+        "Shut the pool down, waiting for what's running if `wait`"
+        self.executor.shutdown(wait)
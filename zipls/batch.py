@@ -0,0 +1,273 @@
+"""Export lots of playlists in one go, from a manifest.
+
+Starting zipls once per playlist means paying for python starting up,
+and reading the same songs' tags cold, every time. A batch runs every
+job in one process, and they all share:
+
+    - a process pool (with more than one job), for reading tags and
+      compressing songs
+    - the tags of every song any of them has seen, and the stat of its
+      file, so each song is only looked at once however many playlists
+      it's in
+    - the directory listings that playlists' songs are looked up in
+
+The jobs themselves run one after another, not side by side on the
+pool: each of them already keeps the pool busy with its own songs, and
+running jobs in order is what lets a later one find an earlier one's
+tags, and keeps the report (and a cancelled batch) simple.
+
+A manifest is a JSON list of jobs, or an object with "jobs" and
+"defaults" (which every job starts from):
+
+    {"defaults": {"format": "{artist} - {title}"},
+     "jobs": [{"playlist": "rock.m3u", "target": "out/rock.zip"},
+              {"playlist": ["a.pls", "b.pls"], "target": "out/ab",
+               "copy": true}]}
+
+Each job needs a "playlist" (a path, or a list of them), and can have
+any of `JOB_KEYS`. `run` returns a report with a dict for each job
+saying how it went.
+"""
+
+from __future__ import with_statement
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from progress import Cancelled, Progress
+from scanner import DirectoryIndex
+from tagcache import MemoryTagCache
+
+DEFAULT_FORMAT = "{track_number:02} - {artist} - {title}.{ext}"
+
+# what a job can say, and what it means
+JOB_KEYS = {
+    'playlist': "the playlist(s) to export",
+    'target': "where to, by default named after the (first) playlist",
+    'copy': "copy into a directory instead of zipping",
+    'format': "what to name the songs",
+    'inner_dir': "the folder inside the zip file",
+    'export_type': "the kind of playlist to write (pls, m3u, xspf, none)",
+    'dedupe': "'path' or 'content', like Songs(dedupe=...)",
+    'update': "only add what's changed to an existing zip file",
+    'sync': "only copy what's changed into an existing directory",
+    'verify': "with update or sync, compare songs' contents too",
+    'max_size': "split the zip file into volumes of this many bytes",
+}
+
+# the keys that are true or false, and what the others can be
+FLAGS = ('copy', 'update', 'sync', 'verify')
+EXPORT_TYPES = ('none', 'pls', 'm3u', 'xspf')
+DEDUPES = ('path', 'content')
+
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+class ManifestError(RuntimeError):
+    "Raised when a manifest doesn't make sense"
+
+def parse_size(text):
+    "Turn '700M', '4g', '1000' into a number of bytes, for argparse"
+    text = text.strip().lower().rstrip('b')
+    multiplier = 1
+    if text and text[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[text[-1]]
+        text = text[:-1]
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r isn't a size" % text)
+
+def load(path):
+    "Return the list of jobs in the manifest at `path` ('-' for stdin)"
+    try:
+        if path == '-':
+            manifest = json.load(sys.stdin)
+        else:
+            with open(os.path.expanduser(path)) as fh:
+                manifest = json.load(fh)
+    except ValueError, e:
+        raise ManifestError("%s isn't JSON: %s" % (path, e))
+    return jobs_from(manifest)
+
+def _native(value):
+    """JSON strings are unicode, make them strs like the command line's
+    paths and formats
+    """
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    return value
+
+def jobs_from(manifest):
+    """Return the jobs in `manifest` (a list of jobs, or a dict with
+    "jobs" and "defaults"), each with the defaults filled in.
+    """
+    defaults = dict()
+    if isinstance(manifest, dict):
+        defaults = manifest.get('defaults', {})
+        manifest = manifest.get('jobs')
+    if not isinstance(manifest, list):
+        raise ManifestError("A manifest is a list of jobs, or an object "
+                            "with a list of \"jobs\"")
+    jobs = list()
+    for i, job in enumerate(manifest):
+        if not isinstance(job, dict):
+            raise ManifestError("job %d isn't an object: %r" % (i + 1, job))
+        job = dict((str(key), _native(value))
+                   for key, value in dict(defaults, **job).items())
+        unknown = sorted(set(job) - set(JOB_KEYS))
+        if unknown:
+            raise ManifestError("job %d has unknown keys: %s"
+                                % (i + 1, ', '.join(unknown)))
+        if not job.get('playlist'):
+            raise ManifestError("job %d doesn't have a playlist" % (i + 1))
+        _check(i + 1, job)
+        jobs.append(job)
+    return jobs
+
+def _check(number, job):
+    """Make sure that the values of `job` (the `number`th) are ones that
+    it can run with, turning its max_size into bytes.
+    """
+    for key in FLAGS:
+        if not isinstance(job.get(key, False), bool):
+            raise ManifestError("job %d's %s should be true or false, not %r"
+                                % (number, key, job[key]))
+    if job.get('export_type') not in (None,) + EXPORT_TYPES:
+        raise ManifestError("job %d's export_type should be one of %s, "
+                            "not %r" % (number, ', '.join(EXPORT_TYPES),
+                                        job['export_type']))
+    if job.get('dedupe') not in (None,) + DEDUPES:
+        raise ManifestError("job %d's dedupe should be one of %s, not %r"
+                            % (number, ', '.join(DEDUPES), job['dedupe']))
+    size = job.get('max_size')
+    if size is None:
+        return
+    if isinstance(size, basestring):
+        try:
+            size = parse_size(size)
+        except argparse.ArgumentTypeError, e:
+            raise ManifestError("job %d's max_size: %s" % (number, e))
+    if isinstance(size, bool) or not isinstance(size, (int, long)) or \
+            size <= 0:
+        raise ManifestError("job %d's max_size should be a number of bytes "
+                            "(or 700M, 4G...), not %r"
+                            % (number, job['max_size']))
+    job['max_size'] = size
+
+def run(songs_class, jobs, workers=1, processes=False, tag_cache=None,
+        compression=None, progress=None):
+    """Run every one of `jobs` (from `jobs_from`), one after another.
+
+    Arguments:
+    `songs_class`: `Songs`, or a subclass of it, to export with.
+    `workers`: `Songs`' `jobs`. With more than one, a process pool
+               that size is shared by every job.
+    `processes`: read tags on that pool instead of on threads.
+    `tag_cache`: a `TagCache` to fall back on for tags this run hasn't
+                 seen yet.
+    `compression`: a `CompressionPolicy` for the zip files.
+    `progress`: a `Progress` that every job reports to. Cancelling it
+                stops the batch.
+
+    Returns a list with a dict for each job: its playlist and target,
+    its "status" ('ok', 'failed', 'cancelled', or 'skipped' for ones
+    that never started because an earlier one was cancelled), how
+    many songs and bytes it did, how many seconds it took, and its
+    "error" if it failed.
+    """
+    if progress is None:
+        progress = Progress()
+    tags = MemoryTagCache(tag_cache)
+    directories = DirectoryIndex()
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+    report = list()
+    try:
+        for job in jobs:
+            result = dict(playlist=job['playlist'],
+                          target=job.get('target'),
+                          status='skipped', songs=0, bytes=0, seconds=0.0)
+            report.append(result)
+            if progress.cancelled:
+                continue
+            tasks = len(progress.tasks)
+            start = time.time()
+            try:
+                outputs = _run_job(songs_class, job, tags, directories,
+                                   pool, workers, processes,
+                                   compression, progress)
+            except Cancelled:
+                result['status'] = 'cancelled'
+            except (Exception, SystemExit), e:
+                result['status'] = 'failed'
+                result['error'] = str(e) or type(e).__name__
+                print >>sys.stderr, "%s failed: %s" % (job['playlist'],
+                                                      result['error'])
+            else:
+                result['status'] = 'ok'
+                result.update(outputs)
+            result['seconds'] = round(time.time() - start, 6)
+            for task in progress.tasks[tasks:]:
+                result['bytes'] += task['bytes']
+    finally:
+        if pool is not None:
+            pool.terminate()
+        tags.close()
+    return report
+
+def _run_job(songs_class, job, tags, directories, pool, workers,
+             processes, compression, progress):
+    """Export one job. Returns what's to go in its report besides its
+    status.
+    """
+    playlists = job['playlist']
+    if isinstance(playlists, basestring):
+        playlists = [playlists]
+    songs = songs_class(playlists,
+                        export_type=job.get('export_type'),
+                        tag_cache=tags,
+                        jobs=workers,
+                        processes=processes,
+                        dedupe=job.get('dedupe'),
+                        lazy=True,
+                        progress=progress,
+                        pool=pool,
+                        directories=directories)
+    target = job.get('target')
+    if not target:
+        target = os.path.splitext(os.path.basename(playlists[0]))[0]
+    fmt = job.get('format', DEFAULT_FORMAT)
+    if not fmt.endswith(".{ext}"):
+        fmt += ".{ext}"
+
+    outputs = dict(target=target)
+    if job.get('copy'):
+        summary = songs.copy_em(target, fmt, sync=job.get('sync', False),
+                                verify=job.get('verify', False))
+        outputs['files'] = summary.files
+    else:
+        volumes = songs.zip_em(target, job.get('inner_dir'), fmt,
+                               compression,
+                               update=job.get('update', False),
+                               verify=job.get('verify', False),
+                               max_size=job.get('max_size'))
+        if volumes is not None:
+            outputs['volumes'] = volumes
+    outputs['songs'] = len(songs)
+    return outputs
+
+def write_report(report, path):
+    "Write `report` (from `run`) to `path` ('-' for stdout) as JSON"
+    if path == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+        return
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
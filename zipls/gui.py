@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
-import Tkinter as Tk, tkFileDialog, tkMessageBox
+import Tkinter as Tk, tkFileDialog, tkMessageBox, ttk
 import os
+import threading
 
 import zipls
 
+# how often, in milliseconds, to look at how an export is going
+POLL_INTERVAL = 100
+
 class Playlists(Tk.Frame):
     def __init__(self, master, playlists=None):
         Tk.Frame.__init__(self, master, padx=6)
@@ -141,6 +145,35 @@ class TargetBox(Tk.Frame):
         self.label_text.set(self.fmt.format(filepath))
         self.label.pack()
 
+class ExportStatus(Tk.Frame):
+    "A progress bar, how fast it's going, and a button to cancel it"
+    def __init__(self, master, cancel):
+        Tk.Frame.__init__(self, master, pady=3)
+
+        self.bar = ttk.Progressbar(self, length=300, mode='determinate')
+        self.bar.pack(fill=Tk.X)
+
+        self.label_text = Tk.StringVar()
+        self.label = Tk.Label(self, textvariable=self.label_text)
+        self.label.pack(side=Tk.LEFT)
+
+        self.cancel_button = Tk.Button(self, text="Cancel", command=cancel)
+        self.cancel_button.pack(side=Tk.RIGHT)
+
+    def show(self, progress):
+        "Show how far `progress` has got"
+        done, total = progress.items_done, progress.items_total
+        self.bar['maximum'] = max(total, 1)
+        self.bar['value'] = done
+        more = ''
+        if progress.counting:
+            more = '+'
+        rate = ''
+        elapsed = progress.elapsed
+        if elapsed > 0:
+            rate = "%.1f MB/s" % (progress.bytes_done / elapsed / (1 << 20))
+        self.label_text.set("%d/%d%s songs  %s" % (done, total, more, rate))
+
 class Controls(Tk.Frame):
     def __init__(self, master, args, Control_Frames):
         Tk.Frame.__init__(self, master)
@@ -149,6 +182,12 @@ class Controls(Tk.Frame):
                                     command=self.zip)
 
         self.args = args
+        self.status = ExportStatus(self, self.cancel)
+        self.progress = None
+        self.worker = None
+        # what the worker ended up with: ('done', songs),
+        # ('cancelled', None) or ('failed', exception)
+        self.outcome = None
 
         for Frame in Control_Frames:
             Frame(self)
@@ -163,20 +202,68 @@ class Controls(Tk.Frame):
             return
 
         target = TargetBox.single.target
+        if target is None:
+            tkMessageBox.showwarning("Eek!", "Nowhere to zip them to!")
+            return
         if not target.endswith('.zip'):
             target = os.path.splitext(target)[0] + '.zip'
 
-        songs = zipls.Songs(plss)
-
         self.args.playlist = plss
         self.args.target = target
-        zipls.main(self.args)
 
-        tkMessageBox.showinfo("Done!",
-                              "Zipped:\n" +
-                              '\n'.join([format(song, '({track_number}) {artist} - {title}')
-                                         for song in songs]) +
-                              "\n\nto: " + target)
+        # the songs are built, and zipped, on another thread, so that
+        # the window keeps working. All that comes back is the
+        # progress, which poll() keeps an eye on.
+        self.progress = zipls.Progress()
+        self.outcome = None
+        self.worker = threading.Thread(target=self._export,
+                                       args=(self.args, self.progress))
+        self.worker.daemon = True
+        self.zip_button.config(state=Tk.DISABLED)
+        self.status.cancel_button.config(state=Tk.NORMAL)
+        self.status.show(self.progress)
+        self.status.pack(fill=Tk.X)
+        self.worker.start()
+        self.after(POLL_INTERVAL, self.poll)
+
+    def _export(self, args, progress):
+        "Runs on the worker thread, so mustn't touch Tk"
+        try:
+            self.outcome = ('done', zipls.main(args, progress))
+        except zipls.Cancelled:
+            self.outcome = ('cancelled', None)
+        except (Exception, SystemExit), e:
+            self.outcome = ('failed', e)
+
+    def cancel(self):
+        self.progress.cancel()
+        self.status.cancel_button.config(state=Tk.DISABLED)
+
+    def poll(self):
+        self.status.show(self.progress)
+        if self.outcome is None and self.worker.is_alive():
+            self.after(POLL_INTERVAL, self.poll)
+            return
+
+        self.status.pack_forget()
+        self.zip_button.config(state=Tk.NORMAL)
+        # the worker can only end without an outcome if something got
+        # past _export's excepts
+        outcome, result = self.outcome or ('failed', "Stopped unexpectedly")
+        if outcome == 'cancelled':
+            tkMessageBox.showinfo("Cancelled",
+                                  "Stopped before finishing " + self.args.target)
+        elif outcome == 'failed':
+            tkMessageBox.showerror("Error! Error!", str(result))
+        elif result is None:
+            # main only returns songs when it exported some
+            tkMessageBox.showinfo("Done!", "Done with " + str(self.args.target))
+        else:
+            tkMessageBox.showinfo("Done!",
+                                  "Zipped:\n" +
+                                  '\n'.join([format(song, '({track_number}) {artist} - {title}')
+                                             for song in result]) +
+                                  "\n\nto: " + self.args.target)
 
 
 def main(args):
@@ -0,0 +1,282 @@
+"""Keep track of how an export is going, and where the time goes.
+
+`Songs` reports to a `Progress`: which song it's on, how many songs and
+bytes are done (out of how many), and how long is spent in each stage
+of the work:
+
+    parse     reading playlists and finding the songs in them
+    tags      reading tags from songs
+    format    working out songs' new names
+    read      reading songs
+    compress  checksumming and compressing them
+    write     writing them out (or copying, or renaming them)
+
+Give it a `callback` to hear about every change, or subclass it and
+override `update`, like `ProgressBar` does. `metrics` sums it all up,
+and `write_metrics` writes that as JSON.
+
+`cancel` stops whatever is reporting to it: the next time it reports
+progress it gets a `Cancelled` exception, and cleans up after itself.
+"""
+
+from __future__ import with_statement
+
+import json
+import os
+import sys
+import threading
+import time
+
+STAGES = ('parse', 'tags', 'format', 'read', 'compress', 'write')
+
+class Cancelled(Exception):
+    "Raised in whatever is reporting to a `Progress` that's been cancelled"
+
+class _Timer(object):
+    "What `Progress.timer` returns"
+    __slots__ = ('progress', 'stage', 'start')
+
+    def __init__(self, progress, stage):
+        self.progress = progress
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.progress.add_time(self.stage, time.time() - self.start)
+
+class Progress(object):
+    """How far through its work a `Songs` is.
+
+    Everything can be called from any thread. Stage times from
+    different threads are added together, so with a pool they can add
+    up to more than the time that has actually passed.
+
+    >>> progress = Progress(lambda p: log(p.items_done, p.items_total))
+    >>> songs = Songs("playlist.m3u", progress=progress)
+    >>> songs.zip_em("playlist.zip")
+    >>> progress.write_metrics("metrics.json")
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.task = None
+        self.items_done = self.items_total = 0
+        self.bytes_done = 0
+        # True while songs are still being found, so items_total is
+        # only how many there are so far
+        self.counting = False
+        self.current = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.tasks = list()
+        self.created = time.time()
+        self.started = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        "Stop the work being reported to us, from any thread"
+        self.cancelled = True
+
+    def check(self):
+        "Raise `Cancelled` if we've been cancelled"
+        if self.cancelled:
+            raise Cancelled()
+
+    def timer(self, stage):
+        """Return a context manager that adds the time spent in it to
+        `stage`.
+
+        >>> with progress.timer('read'):
+        ...     data = fh.read()
+        """
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def timed(self, stage, iterable):
+        "Yield from `iterable`, adding the time it takes to `stage`"
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.time() - start)
+                return
+            self.add_time(stage, time.time() - start)
+            yield item
+
+    def start(self, task, items=0, counting=False):
+        """Start on `task` ('zip', 'copy', 'rename' or 'export'), which
+        has `items` songs to do.
+
+        `counting`: True if there are more songs to come than that.
+        """
+        with self._lock:
+            self._end_task()
+            self.task = task
+            self.items_done = self.bytes_done = 0
+            self.items_total = items
+            self.counting = counting
+            self.current = None
+            self.started = time.time()
+        self.update()
+
+    def found(self, items=1):
+        "Some more songs turned up (while `counting`)"
+        self.check()
+        with self._lock:
+            self.items_total += items
+        self.update()
+
+    def done_counting(self):
+        with self._lock:
+            self.counting = False
+        self.update()
+
+    def expect(self, items):
+        "There are `items` things to do in this task after all"
+        with self._lock:
+            self.items_total = items
+            self.counting = False
+        self.update()
+
+    def song(self, song):
+        "Now working on `song`"
+        self.check()
+        self.current = song
+        self.update()
+
+    def advance(self, items=0, size=0):
+        "`items` more songs, and `size` more bytes, are done"
+        self.check()
+        with self._lock:
+            self.items_done += items
+            self.bytes_done += size
+        self.update()
+
+    def finish(self):
+        "The current task is done"
+        with self._lock:
+            self._end_task()
+            self.current = None
+        self.update()
+
+    def _end_task(self):
+        # call with the lock held
+        if self.task is not None:
+            self.tasks.append(dict(task=self.task,
+                                   items=self.items_done,
+                                   bytes=self.bytes_done,
+                                   seconds=round(time.time() - self.started,
+                                                 6)))
+            self.task = None
+
+    def update(self):
+        "Called after every change. Calls `callback`, if there is one"
+        if self.callback is not None:
+            self.callback(self)
+
+    @property
+    def elapsed(self):
+        "Seconds since the current task started"
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def metrics(self):
+        "Return a dict summing up everything so far, for json"
+        with self._lock:
+            seconds = time.time() - self.created
+            items = sum(task['items'] for task in self.tasks)
+            size = sum(task['bytes'] for task in self.tasks)
+            return dict(seconds=round(seconds, 6),
+                        items=items,
+                        bytes=size,
+                        items_per_second=round(items / seconds, 2)
+                            if seconds else None,
+                        mb_per_second=round(size / seconds / (1 << 20), 2)
+                            if seconds else None,
+                        stages=dict((stage, round(spent, 6))
+                                    for stage, spent in self.stages.items()),
+                        tasks=list(self.tasks))
+
+    def write_metrics(self, path):
+        "Write `metrics` to `path` ('-' for stdout) as JSON"
+        if path == '-':
+            json.dump(self.metrics(), sys.stdout, indent=2, sort_keys=True)
+            print
+            return
+        with open(path, 'w') as fh:
+            json.dump(self.metrics(), fh, indent=2, sort_keys=True)
+
+class ProgressBar(Progress):
+    """A `Progress` that draws a progress bar on a terminal.
+
+    It's redrawn at most every `interval` seconds.
+    """
+    def __init__(self, fh=None, width=30, interval=0.1, callback=None):
+        Progress.__init__(self, callback)
+        if fh is None:
+            fh = sys.stderr
+        self.fh = fh
+        self.width = width
+        self.interval = interval
+        self._drawn = 0
+        self._line = 0
+        self._label = None
+        self._draw_lock = threading.Lock()
+
+    def update(self):
+        Progress.update(self)
+        # if another thread's drawing, that'll do, unless this is the
+        # last time
+        if not self._draw_lock.acquire(self.task is None):
+            return
+        try:
+            now = time.time()
+            if self.task is None:
+                if self._label is not None:
+                    # done: leave the last line there, finished
+                    self.draw(final=True)
+                    self.fh.write('\n')
+                    self._line = 0
+                    self._label = None
+                return
+            self._label = self.task
+            if now - self._drawn >= self.interval:
+                self._drawn = now
+                self.draw()
+        finally:
+            self._draw_lock.release()
+
+    def draw(self, final=False):
+        done, total = self.items_done, self.items_total
+        if total and not self.counting:
+            filled = self.width * min(done, total) // total
+            bar = '#' * filled + '-' * (self.width - filled)
+            count = "%d/%d" % (done, total)
+        else:
+            bar = '?' * self.width
+            count = "%d/%d+" % (done, total)
+        elapsed = self.elapsed
+        rate = ''
+        if elapsed > 0:
+            rate = "%.1f MB/s" % (self.bytes_done / elapsed / (1 << 20))
+        current = ''
+        if self.current is not None and not final:
+            # the file name, because asking for a song's tags could
+            # mean reading them
+            current = os.path.basename(getattr(self.current, 'path',
+                                               str(self.current)))
+            if not isinstance(current, unicode):
+                current = current.decode('utf-8', 'replace')
+        line = u"%s [%s] %s %s %s" % (self._label, bar, count, rate, current)
+        line = u'\r' + line[:78]
+        self.fh.write((line + u' ' * (self._line - len(line)))
+                      .encode('utf-8', 'replace'))
+        self.fh.flush()
+        self._line = len(line)
@@ -0,0 +1,306 @@
+"""Rename lots of files at once, safely.
+
+All of the renames are planned before any of them happen, so that two
+files that would end up with the same name are caught before anything
+is touched, and so that files that are taking each other's names get
+moved in an order that doesn't clobber anything.
+
+The plan can be written to a journal as it's carried out, which is
+enough to finish an interrupted batch (`resume`) or to put everything
+back where it was (`rollback`) without looking at any songs again.
+"""
+
+from __future__ import with_statement
+
+import errno
+import os
+import shutil
+import threading
+from ast import literal_eval
+from multiprocessing.pool import ThreadPool
+
+from progress import Progress
+
+JOURNAL_HEADER = "# zipls rename journal, version 1\n"
+# what files that are in the way get renamed to first
+TEMP_PREFIX = ".zipls-rename-"
+
+class RenameCollision(RuntimeError):
+    "Raised when a rename plan would overwrite something"
+
+def _key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def plan(moves):
+    """Return the (src, dst) steps that will carry out `moves`.
+
+    `moves` is a list of (src, dst) pairs. The steps are in an order
+    that never moves a file onto one that hasn't moved out of the way
+    yet, with files that are swapping names going via a temporary name.
+
+    Raises a `RenameCollision` if two files would get the same name, or
+    if something that isn't being renamed is already using one.
+    """
+    moves = [(src, dst) for src, dst in moves if _key(src) != _key(dst)]
+
+    problems = list()
+    sources = dict()
+    for i, (src, dst) in enumerate(moves):
+        sources[_key(src)] = i
+    destinations = dict()
+    for src, dst in moves:
+        if _key(dst) in destinations:
+            problems.append("both %s and %s would be renamed to %s"
+                            % (destinations[_key(dst)], src, dst))
+        destinations[_key(dst)] = src
+        if _key(dst) not in sources and os.path.lexists(dst):
+            problems.append("renaming %s would overwrite %s" % (src, dst))
+    if problems:
+        raise RenameCollision("Not renaming anything, because:\n    "
+                              + "\n    ".join(problems))
+
+    # A move has to wait for the move (if any) whose source is its
+    # destination. Every source is unique, so following those from any
+    # move gives a chain that either ends or loops back on itself.
+    moves = [list(move) for move in moves]
+    steps = list()
+    state = [0] * len(moves)        # 0: not seen, 1: in this chain, 2: done
+    for i in range(len(moves)):
+        chain = list()
+        j = i
+        while j is not None and state[j] == 0:
+            state[j] = 1
+            chain.append(j)
+            j = sources.get(_key(moves[j][1]))
+        if j is not None and state[j] == 1:
+            # a loop: get j out of the way, and the rest can follow
+            src = moves[j][0]
+            tmp = os.path.join(os.path.dirname(src),
+                               "%s%d-%s" % (TEMP_PREFIX, j,
+                                            os.path.basename(src)))
+            steps.append((src, tmp))
+            moves[j][0] = tmp
+        for j in reversed(chain):
+            steps.append(tuple(moves[j]))
+            state[j] = 2
+    return steps
+
+def _temporary(path):
+    "Is `path` a name that a file is only given to get it out of the way?"
+    return os.path.basename(path).startswith(TEMP_PREFIX)
+
+def _moves(steps):
+    """How many of `steps` move a file to where it's going, rather than
+    out of the way
+    """
+    return len([dst for src, dst in steps if not _temporary(dst)])
+
+class Journal(object):
+    """A record of a rename plan and how far through it we got.
+
+    Each line is a python literal: the steps, in order, and then the
+    index of each step as it's finished.
+    """
+    def __init__(self, path, steps, done=None):
+        self.path = path
+        self.steps = steps
+        self.done = set(done or ())
+        self._lock = threading.Lock()
+        self._fh = None
+
+    @classmethod
+    def create(cls, path, steps):
+        """Write down `steps` at `path`, with their paths made absolute
+        so that they can be resumed from anywhere
+        """
+        steps = [(os.path.abspath(src), os.path.abspath(dst))
+                 for src, dst in steps]
+        journal = cls(path, steps)
+        with open(path, 'w') as fh:
+            fh.write(JOURNAL_HEADER)
+            for i, (src, dst) in enumerate(steps):
+                fh.write(repr(('step', i, src, dst)) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        steps = list()
+        done = set()
+        with open(path) as fh:
+            if fh.readline() != JOURNAL_HEADER:
+                raise RuntimeError("%s isn't a zipls rename journal" % path)
+            for line in fh:
+                try:
+                    record = literal_eval(line)
+                except (SyntaxError, ValueError):
+                    # a half written line from when we were interrupted
+                    continue
+                if record[0] == 'step':
+                    steps.append((record[2], record[3]))
+                elif record[0] == 'done':
+                    done.add(record[1])
+        return cls(path, steps, done)
+
+    def mark_done(self, i):
+        with self._lock:
+            self.done.add(i)
+            if self._fh is None:
+                self._fh = open(self.path, 'a')
+            self._fh.write(repr(('done', i)) + '\n')
+            self._fh.flush()
+            # so that resume knows for sure, instead of guessing
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+def _in_the_way(src, dst):
+    """Is there something at `dst` that moving `src` there would
+    destroy? Not if it's `src` itself, under a name that only differs
+    in case.
+    """
+    if not os.path.lexists(dst):
+        return False
+    try:
+        a, b = os.lstat(src), os.lstat(dst)
+    except OSError:
+        return True
+    return (a.st_dev, a.st_ino) != (b.st_dev, b.st_ino)
+
+def _same_device(src, dst):
+    try:
+        return (os.stat(src).st_dev ==
+                os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    except OSError:
+        return False
+
+def execute(steps, journal=None, jobs=4, progress=None, unchanged=0):
+    """Carry out `steps` (from `plan`).
+
+    Renames on the same filesystem happen right away with `os.rename`.
+    Ones that have to copy across devices go to a pool of `jobs`
+    threads, and only steps that involve the same files wait for them.
+
+    Nothing is ever overwritten: a step whose destination is already
+    there (say a resumed batch's journal didn't get as far as the
+    files did) raises a `RenameCollision`.
+
+    `progress`: a `progress.Progress` to tell about each file once it's
+                where it's going. Files only being moved out of the way
+                don't count, and `unchanged` files that didn't need
+                moving at all count as done already.
+    """
+    if progress is None:
+        progress = Progress()
+    progress.expect(_moves(steps) + unchanged)
+    progress.advance(unchanged)
+    pool = None
+    in_flight = dict()   # path key -> AsyncResult
+    results = list()
+    try:
+        for i, (src, dst) in enumerate(steps):
+            files = int(not _temporary(dst))
+            if journal is not None and i in journal.done:
+                progress.advance(files)
+                continue
+            for key in (_key(src), _key(dst)):
+                if key in in_flight:
+                    in_flight.pop(key).get()
+            if _in_the_way(src, dst):
+                raise RenameCollision("Not renaming %s, because it would "
+                                      "overwrite %s" % (src, dst))
+            if _same_device(src, dst):
+                try:
+                    with progress.timer('write'):
+                        os.rename(src, dst)
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                else:
+                    if journal is not None:
+                        journal.mark_done(i)
+                    progress.advance(files)
+                    continue
+            if pool is None:
+                pool = ThreadPool(jobs)
+            result = pool.apply_async(_move, (src, dst, i, journal,
+                                              progress, files))
+            in_flight[_key(src)] = in_flight[_key(dst)] = result
+            results.append(result)
+        for result in results:
+            result.get()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if journal is not None:
+            journal.close()
+
+def _move(src, dst, i, journal, progress, files):
+    # don't start on anything new once we've been cancelled
+    progress.check()
+    with progress.timer('write'):
+        shutil.move(src, dst)
+    if journal is not None:
+        journal.mark_done(i)
+    progress.advance(files)
+
+def rename(moves, journal_path=None, jobs=4, progress=None):
+    """Plan and carry out `moves`, a list of (src, dst) pairs.
+
+    If `journal_path` is given the plan and progress are written there
+    first, for `resume` and `rollback`. `progress` is for `execute`.
+    """
+    steps = plan(moves)
+    journal = None
+    if journal_path is not None:
+        journal = Journal.create(journal_path, steps)
+    execute(steps, journal, jobs, progress,
+            unchanged=len(moves) - _moves(steps))
+
+def _finished(journal):
+    """Add steps that happened but didn't get written down to `done`.
+
+    That's ones whose source is gone and whose destination is there,
+    or whose source has been filled again by a later step that
+    happened.
+    """
+    # where steps from later on that happened moved things to
+    refilled = set()
+    for i in reversed(range(len(journal.steps))):
+        src, dst = journal.steps[i]
+        if i not in journal.done and os.path.lexists(dst) and \
+                (not os.path.lexists(src) or _key(src) in refilled):
+            journal.done.add(i)
+        if i in journal.done:
+            refilled.add(_key(dst))
+
+def resume(journal_path, jobs=4, progress=None):
+    "Finish the renames in the journal at `journal_path`"
+    journal = Journal.load(journal_path)
+    _finished(journal)
+    execute(journal.steps, journal, jobs, progress)
+
+def rollback(journal_path):
+    """Undo every rename in the journal at `journal_path`, last first
+
+    Steps are undone if their destination is there and their source
+    isn't, which also catches the ones that were interrupted before
+    they could be written down as done.
+    """
+    journal = Journal.load(journal_path)
+    for src, dst in reversed(journal.steps):
+        if not os.path.lexists(dst) or os.path.lexists(src):
+            continue
+        try:
+            os.rename(dst, src)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(dst, src)
+    os.remove(journal_path)
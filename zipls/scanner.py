@@ -0,0 +1,191 @@
+"""Find the songs below a directory without wasting time on it.
+
+Directories are listed with `scandir` where it's available (os.scandir
+on python 3.5+, or the scandir package from PyPI), which gets whether
+each name is a file or a directory from the listing itself instead of
+asking the filesystem again for every one. Without it `os.listdir` and
+a stat per name do the same job, more slowly.
+
+With more than one job the directories that are going to be needed
+next are listed on a pool of threads while the files in the current
+one are handed out, which helps most on network filesystems where
+every listing is a round trip.
+"""
+
+from __future__ import with_statement
+
+import os
+import stat
+import sys
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _matches(relpath, patterns):
+    return any(fnmatch(relpath, pattern) for pattern in patterns)
+
+def _list_dir(path):
+    """Return ([(name, stat), ...], [subdirectory name, ...]) for `path`.
+
+    Symlinks to directories aren't followed, like `os.walk`. Names
+    whose stat fails (dangling symlinks, say) are left out.
+    """
+    files = list()
+    dirs = list()
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append((entry.name, entry.stat()))
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.islink(os.path.join(path, name)):
+                    dirs.append(name)
+            elif stat.S_ISREG(st.st_mode):
+                files.append((name, st))
+    files.sort()
+    dirs.sort()
+    return files, dirs
+
+def _safe_list_dir(path):
+    try:
+        return _list_dir(path)
+    except OSError, e:
+        print >>sys.stderr, "could not look in %s: %s" % (path, e)
+        return [], []
+
+def scan(root, extensions, include=(), exclude=(), jobs=1):
+    """Yield (path, stat) for every song below `root`.
+
+    They come in the same order every time: the files in a directory,
+    sorted, then everything under each of its subdirectories in turn.
+
+    Arguments:
+    `extensions`: the extensions (lower case, without the dot) of the
+                  files that count as songs.
+    `include`: glob patterns. If there are any, only files whose path
+               (relative to root) matches one of them are songs.
+    `exclude`: glob patterns for files, and directories, to skip.
+    `jobs`: how many directories to list at once.
+    """
+    pool = None
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+    # directories still to look in, the next one last. Each is
+    # [relative path, listing result or None]
+    stack = [['', None]]
+    try:
+        while stack:
+            reldir, listing = stack.pop()
+            if listing is None:
+                files, dirs = _safe_list_dir(os.path.join(root, reldir))
+            else:
+                files, dirs = listing.get()
+
+            for name in reversed(dirs):
+                relpath = os.path.join(reldir, name)
+                if not _matches(relpath, exclude):
+                    stack.append([relpath, None])
+            if pool is not None:
+                # start on the next few directories while whoever's
+                # asking deals with the files in this one
+                for item in stack[-2 * jobs:]:
+                    if item[1] is None:
+                        item[1] = pool.apply_async(
+                            _safe_list_dir, (os.path.join(root, item[0]),))
+            for name, st in files:
+                if name[name.rfind('.')+1:].lower() not in extensions:
+                    continue
+                relpath = os.path.join(reldir, name)
+                if include and not _matches(relpath, include):
+                    continue
+                if _matches(relpath, exclude):
+                    continue
+                yield os.path.join(root, relpath), st
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+class DirectoryIndex(object):
+    """Finds files by looking them up in directory listings, instead of
+    asking the filesystem about each one.
+
+    Every directory is listed at most once (including finding out that
+    it isn't there), so the songs in a playlist cost a listing per
+    directory they're in instead of a stat each. The listings are kept
+    for as long as the index is.
+
+    Paths that don't exist as written are tried again with backslashes
+    as separators, and ignoring case, for playlists made on Windows or
+    a Mac.
+    """
+    def __init__(self):
+        # dirname -> (names, {lower cased name: name}), or None
+        self._listings = dict()
+
+    def _listing(self, dirname):
+        try:
+            return self._listings[dirname]
+        except KeyError:
+            pass
+        try:
+            names = os.listdir(dirname or os.curdir)
+        except OSError:
+            listing = None
+        else:
+            lower = dict()
+            for name in sorted(names):
+                lower.setdefault(name.lower(), name)
+            listing = frozenset(names), lower
+        self._listings[dirname] = listing
+        return listing
+
+    def resolve(self, path):
+        """Return the path that the file `path` is really at, or None.
+
+        That's `path` itself if it's there as written.
+        """
+        dirname, name = os.path.split(path)
+        listing = self._listing(dirname)
+        if listing is not None and name in listing[0]:
+            return path
+
+        # go down from the top, a directory at a time
+        drive, rest = os.path.splitdrive(path)
+        parts = rest.replace('\\', '/').split('/')
+        current = drive
+        if parts[0] == '':
+            current += os.sep
+        for part in parts:
+            if part == '':
+                continue
+            if part in (os.curdir, os.pardir):
+                current = os.path.join(current, part)
+                continue
+            listing = self._listing(current)
+            if listing is None:
+                return None
+            names, lower = listing
+            if part not in names:
+                part = lower.get(part.lower())
+                if part is None:
+                    return None
+            current = os.path.join(current, part)
+        return current
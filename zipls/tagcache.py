@@ -0,0 +1,294 @@
+"""A persistent cache of song tags, so that we don't have to ask
+mutagen about the same files every time we run.
+
+Entries are keyed on the absolute path of the song and are only
+trusted if the file's size and mtime haven't changed since they were
+written.
+
+It also keeps the CRC32s of songs that have been zipped without being
+compressed, which is all that's needed to copy them straight into a
+zip file without reading them first.
+"""
+
+from __future__ import with_statement
+
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+import weakref
+
+DEFAULT_PATH = os.path.join("~", ".cache", "zipls", "tags.sqlite")
+DEFAULT_MAX_ENTRIES = 250000
+
+TAGS = ('title', 'artist', 'album', 'track_number', 'length')
+
+# the caches that haven't been closed yet, which get closed at exit.
+# Weakly, so that this doesn't keep ones nobody's using alive.
+_open_caches = weakref.WeakSet()
+
+def _close_all():
+    for cache in list(_open_caches):
+        cache.close()
+
+atexit.register(_close_all)
+
+def _db_path(path):
+    """`path` as something sqlite will take: text, if it's in the
+    filesystem's encoding like nearly every path is, otherwise its
+    bytes as a blob
+    """
+    if isinstance(path, unicode):
+        return path
+    try:
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return sqlite3.Binary(path)
+
+class TagCache(object):
+    """An SQLite-backed cache of the tags `Song._read_tags` returns.
+
+    Writes are batched and committed every `commit_every` puts, and
+    when the cache is closed (which also happens at exit, to any that
+    are still around). When there
+    are more than `max_entries` songs in the cache the ones that have
+    gone unused for the most runs are thrown away.
+
+    >>> with TagCache("/tmp/tags.sqlite") as cache:
+    ...     if cache.get("song.mp3") is None:
+    ...         cache.put("song.mp3", read_the_tags("song.mp3"))
+    """
+    def __init__(self, path=DEFAULT_PATH,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 commit_every=1000):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = self.misses = 0
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # songs can load their tags from worker threads, so all access
+        # goes through the lock instead of a connection per thread.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.text_factory = unicode
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                         " path TEXT PRIMARY KEY,"
+                         " size INTEGER, mtime REAL, used INTEGER,"
+                         " title TEXT, artist TEXT, album TEXT,"
+                         " track_number INTEGER, length INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tags_used"
+                         " ON tags (used)")
+        # the CRC32s of whole files, for zipping them without reading
+        # them first
+        self._db.execute("CREATE TABLE IF NOT EXISTS crcs ("
+                         " path TEXT PRIMARY KEY,"
+                         " size INTEGER, mtime REAL, used INTEGER,"
+                         " crc INTEGER)")
+        self.run = (self._db.execute("SELECT MAX(used) FROM tags")
+                    .fetchone()[0] or 0) + 1
+        self._pending = 0
+        self._closed = False
+        _open_caches.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _key(path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        return _db_path(os.path.abspath(path)), stat.st_size, stat.st_mtime
+
+    def get(self, path, stat=None):
+        """Return the cached tag dict for `path`, or None.
+
+        `stat`: an `os.stat` result for path, if you've already got one.
+        """
+        path, size, mtime = self._key(path, stat)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime, used, "
+                                   + ', '.join(TAGS) +
+                                   " FROM tags WHERE path = ?",
+                                   (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if row[2] != self.run:
+                self._db.execute("UPDATE tags SET used = ? WHERE path = ?",
+                                 (self.run, path))
+                self._wrote()
+        return dict(zip(TAGS, row[3:]))
+
+    def put(self, path, tags, stat=None):
+        "Remember `tags` (a dict like `get` returns) for `path`"
+        path, size, mtime = self._key(path, stat)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO tags VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (path, size, mtime, self.run) +
+                             tuple(tags.get(tag) for tag in TAGS))
+            self._wrote()
+
+    def get_crc(self, path, stat=None):
+        "Return the CRC32 of the file at `path`, if it's been `put_crc`"
+        path, size, mtime = self._key(path, stat)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime, used, crc"
+                                   " FROM crcs WHERE path = ?",
+                                   (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                return None
+            if row[2] != self.run:
+                self._db.execute("UPDATE crcs SET used = ? WHERE path = ?",
+                                 (self.run, path))
+                self._wrote()
+        return row[3]
+
+    def put_crc(self, path, crc, stat=None):
+        "Remember that the file at `path` has the CRC32 `crc`"
+        path, size, mtime = self._key(path, stat)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO crcs VALUES "
+                             "(?, ?, ?, ?, ?)",
+                             (path, size, mtime, self.run, crc))
+            self._wrote()
+
+    def _wrote(self):
+        # call with the lock held
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._db.commit()
+            self._pending = 0
+
+    def _evict(self):
+        # call with the lock held
+        for table in ('tags', 'crcs'):
+            count = self._db.execute("SELECT COUNT(*) FROM %s"
+                                     % table).fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute("DELETE FROM %s WHERE path IN "
+                                 "(SELECT path FROM %s ORDER BY used LIMIT ?)"
+                                 % (table, table),
+                                 (count - self.max_entries,))
+
+    def flush(self):
+        "Commit anything that hasn't been written yet"
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        if self._closed:
+            return
+        with self._lock:
+            self._closed = True
+            _open_caches.discard(self)
+            self._evict()
+            self._db.commit()
+            self._db.close()
+
+class MemoryTagCache(object):
+    """Tags, and stats, kept in memory for as long as the cache is.
+
+    For running lots of exports in one process, where the same songs
+    keep turning up: each song's file is only stat-ed, and its tags only
+    read, once. Anything it doesn't know is looked for in `backing` (a
+    `TagCache`, say), and anything it's told goes there too.
+    """
+    def __init__(self, backing=None):
+        self.backing = backing
+        self.hits = self.misses = 0
+        self._tags = dict()
+        self._crcs = dict()
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stat(self, path):
+        "Return `os.stat(path)`, the first time it's asked for"
+        path = os.path.abspath(path)
+        try:
+            return self._stats[path]
+        except KeyError:
+            st = self._stats[path] = os.stat(path)
+            return st
+
+    def _key(self, path, stat=None):
+        if stat is None:
+            stat = self.stat(path)
+        else:
+            self._stats.setdefault(os.path.abspath(path), stat)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+    def get(self, path, stat=None):
+        """Return the tag dict for `path`, or None.
+
+        `stat`: an `os.stat` result for path, if you've already got one.
+        """
+        key = self._key(path, stat)
+        with self._lock:
+            tags = self._tags.get(key)
+        if tags is None and self.backing is not None:
+            tags = self.backing.get(path, self._stats[key[0]])
+            if tags is not None:
+                with self._lock:
+                    self._tags[key] = tags
+        if tags is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(tags)
+
+    def put(self, path, tags, stat=None):
+        "Remember `tags` (a dict like `get` returns) for `path`"
+        key = self._key(path, stat)
+        with self._lock:
+            self._tags[key] = dict(tags)
+        if self.backing is not None:
+            self.backing.put(path, tags, self._stats[key[0]])
+
+    def get_crc(self, path, stat=None):
+        "Return the CRC32 of the file at `path`, if we know it"
+        key = self._key(path, stat)
+        with self._lock:
+            crc = self._crcs.get(key)
+        if crc is None and self.backing is not None:
+            crc = self.backing.get_crc(path, self._stats[key[0]])
+            if crc is not None:
+                with self._lock:
+                    self._crcs[key] = crc
+        return crc
+
+    def put_crc(self, path, crc, stat=None):
+        "Remember that the file at `path` has the CRC32 `crc`"
+        key = self._key(path, stat)
+        with self._lock:
+            self._crcs[key] = crc
+        if self.backing is not None:
+            self.backing.put_crc(path, crc, self._stats[key[0]])
+
+    def flush(self):
+        if self.backing is not None:
+            self.backing.flush()
+
+    def close(self):
+        "Forget everything. The backing cache is left open"
+        with self._lock:
+            self._tags.clear()
+            self._crcs.clear()
+            self._stats.clear()
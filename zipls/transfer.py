@@ -0,0 +1,278 @@
+"""Get the bytes of one file into another as cheaply as the filesystem
+allows.
+
+Every way of doing it is tried in turn until one works:
+
+    hardlink   no copying at all, but both names are the same file
+    reflink    a copy-on-write clone (btrfs, XFS, ...)
+    range      copy_file_range, so the kernel does the copying
+    copy       plain old reading and writing
+
+`STRATEGIES` names which of those each strategy is allowed to try.
+"""
+
+from __future__ import with_statement
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import shutil
+import sys
+
+CHUNK_SIZE = 1 << 20
+# how much of the start and end of files partial_digest looks at
+PARTIAL_SIZE = 64 << 10
+# FAT, which is what most portable players use, only keeps modification
+# times to two seconds
+MTIME_SLOP = 2
+
+STRATEGIES = {
+    'hardlink': ('hardlink', 'reflink', 'range', 'copy'),
+    'fast': ('reflink', 'range', 'copy'),
+    'copy': ('copy',),
+    }
+DEFAULT_STRATEGY = 'fast'
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# the errors that just mean "this filesystem/kernel can't do that"
+_UNSUPPORTED = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.EPERM, errno.EBADF, errno.EMLINK])
+
+class Unsupported(Exception):
+    "Raised by a method that can't be used for a particular transfer"
+
+class Summary(object):
+    """What a batch of transfers did, in files and bytes.
+
+    >>> summary = Summary()
+    >>> summary.add('copied', 3000000)
+    >>> summary.add('skipped', 5000)
+    >>> print summary
+    copied 1 file (2.9 MB), skipped 1 file (4.9 KB)
+    """
+    def __init__(self):
+        self.files = dict()
+        self.bytes = dict()
+        self._order = list()
+
+    def add(self, action, size):
+        if action not in self.files:
+            self._order.append(action)
+            self.files[action] = self.bytes[action] = 0
+        self.files[action] += 1
+        self.bytes[action] += size
+
+    def __str__(self):
+        if not self._order:
+            return "nothing to do"
+        return ', '.join("%s %d file%s (%s)" % (
+                action, self.files[action],
+                '' if self.files[action] == 1 else 's',
+                human_size(self.bytes[action]))
+                         for action in self._order)
+
+def human_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    if unit == 'bytes':
+        return "%d bytes" % size
+    return "%.1f %s" % (size, unit)
+
+def file_digest(path):
+    "Return the sha1 of the file at `path`"
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+def partial_digest(path, size=None):
+    """Return a sha1 of the size, start and end of the file at `path`.
+
+    Files with different partial digests are certainly different, files
+    with the same one need a `file_digest` to be sure.
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size))
+    with open(path, 'rb') as fh:
+        digest.update(fh.read(PARTIAL_SIZE))
+        if size > 2 * PARTIAL_SIZE:
+            fh.seek(-PARTIAL_SIZE, os.SEEK_END)
+            digest.update(fh.read(PARTIAL_SIZE))
+    return digest.digest()
+
+def up_to_date(src, dst, verify=False):
+    """Does `dst` look like it's already a copy of `src`?
+
+    They have to be the same size, and modified at the same time (give
+    or take `MTIME_SLOP`). With `verify` their contents are compared,
+    too.
+    """
+    try:
+        dst_st = os.stat(dst)
+    except OSError:
+        return False
+    src_st = os.stat(src)
+    if src_st.st_size != dst_st.st_size or \
+            abs(src_st.st_mtime - dst_st.st_mtime) > MTIME_SLOP:
+        return False
+    return not verify or file_digest(src) == file_digest(dst)
+
+def transfer(src, dst, strategy=DEFAULT_STRATEGY):
+    """Make `dst` a copy of `src`, replacing it if it's already there.
+
+    Returns the name of the method that worked.
+    """
+    methods = STRATEGIES[strategy]
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        if os.path.realpath(src) == os.path.realpath(dst):
+            raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
+        if 'hardlink' in methods:
+            return 'hardlink'
+        # don't write through a hard link into the original
+        os.remove(dst)
+    for method in methods:
+        try:
+            _METHODS[method](src, dst)
+        except Unsupported:
+            continue
+        return method
+    raise RuntimeError("Couldn't copy %s to %s" % (src, dst))
+
+def _hardlink(src, dst):
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except (OSError, AttributeError), e:
+        if getattr(e, 'errno', errno.ENOSYS) in _UNSUPPORTED:
+            raise Unsupported()
+        raise
+
+def _reflink(src, dst):
+    if not sys.platform.startswith('linux'):
+        raise Unsupported()
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except IOError, e:
+                if e.errno in _UNSUPPORTED:
+                    raise Unsupported()
+                raise
+    shutil.copystat(src, dst)
+
+def _find_copy_file_range():
+    "Return a copy_file_range(src_fd, dst_fd, count) function, or None"
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def copy_file_range(src, dst, count):
+        copied = func(src, None, dst, None, count, 0)
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return copied
+    return copy_file_range
+
+_copy_file_range = _find_copy_file_range()
+
+def _find_sendfile():
+    "Return a sendfile(src_fd, dst_fd, count) function, or None"
+    if hasattr(os, 'sendfile'):
+        return lambda src, dst, count: os.sendfile(dst, src, None, count)
+    # the BSDs' and the Mac's take different arguments
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(src, dst, count):
+        sent = func(dst, src, None, count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+_sendfile = _find_sendfile()
+
+def copy_fd(src, dst, count):
+    """Copy up to `count` bytes from the file descriptor `src` to `dst`,
+    from and to wherever each of them is at, without them ever leaving
+    the kernel.
+
+    copy_file_range is tried first, which only works between regular
+    files, then sendfile, which can also write to pipes and sockets.
+    Returns how many bytes were copied, 0 at the end of src. Raises
+    `Unsupported` if neither of them can do it.
+    """
+    for func in (_copy_file_range, _sendfile):
+        if func is None:
+            continue
+        try:
+            return func(src, dst, count)
+        except OSError, e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    raise Unsupported()
+
+def _range(src, dst):
+    if _copy_file_range is None:
+        raise Unsupported()
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            copied = 0
+            while True:
+                try:
+                    n = _copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                         CHUNK_SIZE * 64)
+                except OSError, e:
+                    # once something's been copied it's a real error
+                    if copied == 0 and e.errno in _UNSUPPORTED:
+                        raise Unsupported()
+                    raise
+                if n == 0:
+                    break
+                copied += n
+    shutil.copystat(src, dst)
+
+def _copy(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    shutil.copystat(src, dst)
+
+_METHODS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'range': _range,
+    'copy': _copy,
+    }
@@ -21,12 +21,39 @@ Currently supports .pls, .m3u, and .xspf playlists.
 from __future__ import with_statement
 
 import argparse
+import hashlib
+import multiprocessing
 import os
+import Queue
 import shutil
 import sys
-from zipfile import ZipFile
-from xml.dom import minidom
-from HTMLParser import HTMLParser
+import threading
+import urllib
+from collections import deque, OrderedDict
+from functools import partial
+from string import Formatter
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+from multiprocessing.pool import ThreadPool
+from zipfile import BadZipfile, ZIP_DEFLATED, ZIP_STORED
+from urlparse import urlparse
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+import batch
+import progress
+import renamer
+import scanner
+import tagcache
+import transfer
+from batch import parse_size
+from progress import Cancelled, Progress, ProgressBar
+from tagcache import TagCache
+import zipwriter
+from zipwriter import (CompressionPolicy, ZipWriter, END_SIZE,
+                       deflate_file, file_crc, member_size, same_file)
 
 MUTAGEN = False
 try:
@@ -38,10 +65,29 @@ else:
 
 VERSION = "0.2.1a"
 
+# how much of a song export() reads at a time
+FANOUT_CHUNK_SIZE = 4 << 20
+# how many songs a lazy Songs builds ahead of whoever's exporting them
+DEFAULT_QUEUE_SIZE = 64
+# how many songs go to a tag-reading process at a time
+TAG_BATCH_SIZE = 16
+# how big a volume's playlist can get before it has any songs in it
+PLAYLIST_HEADER_SIZE = 512
+
 #######################################################################
 # Core Classes
 
 class Song(object):
+    """A single audio file and its tags.
+
+    Tags that aren't handed to the constructor (title, artist, album,
+    track_number and length) are read from the file all at once, the
+    first time any of them is asked for.
+    """
+    __slots__ = ('path', 'ext',
+                 '_title', '_artist', '_album', '_track_number', '_length',
+                 '_tags_loaded', '_tag_cache', '_stat')
+
     _warned_about_no_mutagen = False
     def __init__(self, path,
                  title=None,
@@ -49,35 +95,45 @@ class Song(object):
                  ext=None,
                  track_number=None,
                  album=None,
-                 length=None):
+                 length=None,
+                 tag_cache=None,
+                 stat=None,
+                 exists=False):
         """Needs at the very least a path to a file.
 
         Pretty dumb about setting the artist, too.
+
+        `tag_cache`: a `TagCache` to check before reading tags from
+                     the file.
+        `stat`: an `os.stat` result for the file, if you've already got
+                one. The file is assumed to exist, and the tag cache
+                uses it instead of looking again.
+        `exists`: don't check that the file exists, because you already
+                  know it does.
         """
-        if not os.path.exists(path):
+        if stat is None and not exists and not os.path.exists(path):
             raise OSError("Does not Exist")
         self.path = path
-
-        self.title = title
-        if self.title is None:
-            self._set_title()
+        self._stat = stat
 
         self.ext = ext
         if self.ext is None:
             self._set_ext_from_path(path)
 
-        self.artist = artist
-        if self.artist is None:
-            self._set_artist()
-
-        self.track_number = track_number
-        if self.track_number is not None:
-            self.track_number = int(self.track_number)
-        self.album = album
+        self._title = title
+        self._artist = artist
+        self._album = album
+        self._track_number = track_number
+        if track_number is not None:
+            self._track_number = int(track_number)
         self._length = length
+        self._tags_loaded = False
+        self._tag_cache = tag_cache
 
     def __str__(self):
         def ftag(tag):
+            if isinstance(tag, basestring):
+                return tag
             return ', '.join(tag)
         name = ""
         if self.artist is not None:
@@ -110,54 +166,7 @@ class Song(object):
         >>> format(song, "{artist:s}")
         'Someone/Special'
         """
-        def _read_tag(fmt):
-            "return (tag, fmt)"
-            orig = fmt
-            spec = ""
-            string = ""
-            while True and fmt:
-                if fmt[0] == '}':
-                    fmt = fmt[1:]
-                    return string, spec, fmt
-                elif fmt[0] == ":":
-                    while fmt[0] != '}':
-                        spec += fmt[0]
-                        fmt = fmt[1:]
-                else:
-                    string += fmt[0]
-                    fmt = fmt[1:]
-            raise RuntimeError("Unclosed tag in format, originally: %s" %
-                               orig)
-
-        ################################################################
-        # format!
-        original = fmt
-        tags = list()
-        specs = list()
-        while fmt:
-            if fmt[0] == '{':
-                tag, spec, fmt = _read_tag(fmt[1:])
-                tags.append(tag)
-                specs.append(spec)
-            else:
-                fmt = fmt[1:]
-        try:
-            attrs = list()
-            for tag, spec in zip(tags, specs):
-                item = getattr(self, tag)
-                if not 's' in spec and not isinstance(item, int):
-                    try:
-                        item = item.replace('/', '_')
-                    except AttributeError:
-                        pass # don't care about non-strings
-                attrs.append((tag, item))
-
-            attrs = dict(attrs)
-
-        except AttributeError, e:
-            sys.exit("Can't format like you want because: %s" % e)
-
-        return original.format(**attrs)
+        return compile_format(fmt, type(self)).render(self)
 
     def __eq__(self, other):
         return self.path == other.path and \
@@ -167,9 +176,29 @@ class Song(object):
             self.album == other.album
             # don't care about track numbers, though?
 
+    ################################################################
+    # Lazily loaded tags
+    def _lazy_tag(name):
+        attr = '_' + name
+        def getter(self):
+            if getattr(self, attr) is None and not self._tags_loaded:
+                self._load_tags()
+            return getattr(self, attr)
+        def setter(self, value):
+            setattr(self, attr, value)
+        return property(getter, setter)
+
+    title = _lazy_tag('title')
+    artist = _lazy_tag('artist')
+    album = _lazy_tag('album')
+    track_number = _lazy_tag('track_number')
+    _lazy_length = _lazy_tag('length')
+    del _lazy_tag
+
     @property
     def length(self):
-        return (self._length if self._length
+        length = self._lazy_length
+        return (length if length
                 else -1)
 
     def _set_ext_from_path(self, path):
@@ -178,53 +207,304 @@ class Song(object):
             # since rfind returns -1 on error
             raise OSError("Couldn't set extension")
 
-    def _set_title(self):
-        try:
-            audio = mutagen.File(self.path, easy=True)
-            self.title = audio['title']
-        except KeyError:
-            name, ext  = os.path.splitext(self.path)
-            self.title = os.path.basename(name)
+    def _load_tags(self):
+        """Fill in every tag that wasn't given to the constructor.
 
-    def _set_artist(self):
-        if MUTAGEN:
-            try:
-                audio = mutagen.File(self.path, easy=True)
-                self.artist = audio['artist']
-            except KeyError:
+        Only ever runs once per song, and only opens the file once.
+        """
+        tags = None
+        if self._tag_cache is not None:
+            tags = self._tag_cache.get(self.path, self._stat)
+        if tags is None:
+            tags = self._read_tags()
+            if self._tag_cache is not None and MUTAGEN:
+                self._tag_cache.put(self.path, tags, self._stat)
+        self._set_tags(tags)
+
+    def _set_tags(self, tags):
+        "Fill in missing tags from a dict like `_read_tags` returns"
+        self._tags_loaded = True
+        self._stat = None
+        if self._title is None:
+            self._title = tags['title']
+            if self._title is None:
+                name, ext = os.path.splitext(self.path)
+                self._title = os.path.basename(name)
+        if self._artist is None:
+            self._artist = tags['artist']
+            if self._artist is None and MUTAGEN:
                 print >>sys.stderr, "Could not get artist for {0}".format(self.path)
-                self.artist = ''
-        else:
+                self._artist = ''
+        if self._album is None:
+            self._album = tags['album']
+        if self._track_number is None:
+            self._track_number = tags['track_number']
+        if self._length is None:
+            self._length = tags['length']
+
+    def _read_tags(self):
+        """Return a dict of whatever tags mutagen can find in the file.
+
+        Missing tags are None, strings are joined with ', ' the way
+        `__str__` always has.
+        """
+        tags = dict.fromkeys(('title', 'artist', 'album',
+                              'track_number', 'length'))
+        if not MUTAGEN:
             if not Song._warned_about_no_mutagen:
                 print >>sys.stderr, "No ID3 tag library installed, so can't extract artist from mp3 tag.\n"\
                     "(install mutagen)"
                 Song._warned_about_no_mutagen = True
+            return tags
+
+        audio = mutagen.File(self.path, easy=True)
+        if audio is None:
+            return tags
+
+        for tag in ('title', 'artist', 'album'):
+            if tag in audio:
+                tags[tag] = ', '.join(audio[tag])
+        if 'tracknumber' in audio:
+            try:
+                tags['track_number'] = int(audio['tracknumber'][0].split('/')[0])
+            except ValueError:
+                pass
+        if getattr(audio, 'info', None) is not None:
+            tags['length'] = int(getattr(audio.info, 'length', 0)) or None
+        return tags
+
+class FormatError(RuntimeError):
+    "Raised for format strings that `Song`s can't be formatted with"
+
+def _song_fields(song_class):
+    """Return the names every `song_class` has: the class's own, and
+    what its `__slots__` give each song.
+
+    Returns None if songs can have any attribute at all (because some
+    class they are doesn't have `__slots__`), since then there's no
+    telling until there's a song.
+    """
+    fields = set(dir(song_class))
+    for klass in song_class.__mro__:
+        if klass is object:
+            continue
+        if '__slots__' not in vars(klass):
+            return None
+        slots = vars(klass)['__slots__']
+        if isinstance(slots, basestring):
+            slots = [slots]
+        fields.update(slots)
+    return fields
+
+class SongFormat(object):
+    """A format string, parsed once, that can render lots of songs.
+
+    Use `compile_format` to get one, it keeps the most recently used
+    ones around.
+
+    >>> fmt = compile_format("{track_number:02} - {artist} - {title}.{ext}")
+    >>> fmt.render(song)
+    '01 - Someone Special - Sample.mp3'
+    """
+    def __init__(self, fmt, song_class=Song):
+        """Parse `fmt`, and make sure `song_class` has all of its tags.
+
+        Raises a `FormatError` if it doesn't. If `song_class`'s songs
+        can have attributes it doesn't declare, that waits for `render`.
+        """
+        self.fmt = fmt
+        self.fields = list()
+        self.tags = list()
+        # whether rendering needs the tags that are read from the file
+        self.needs_tags = False
+        try:
+            parsed = list(Formatter().parse(fmt))
+        except ValueError, e:
+            raise FormatError("Can't format like you want because: %s (in %s)"
+                              % (e, fmt))
+        fields = _song_fields(song_class)
+        for literal, tag, spec, conversion in parsed:
+            if tag is not None:
+                if fields is not None and tag not in fields:
+                    raise _no_tag(tag)
+                self.tags.append(tag)
+                if tag in tagcache.TAGS:
+                    self.needs_tags = True
+            self.fields.append((literal, tag, spec or '', conversion,
+                                # 's' anywhere in the spec means don't
+                                # replace '/'s
+                                spec is not None and 's' in spec))
+
+    def render(self, song):
+        parts = list()
+        for literal, tag, spec, conversion, safe in self.fields:
+            parts.append(literal)
+            if tag is None:
+                continue
+            try:
+                item = getattr(song, tag)
+            except AttributeError:
+                raise _no_tag(tag)
+            if not safe and not isinstance(item, int):
+                try:
+                    item = item.replace('/', '_')
+                except AttributeError:
+                    pass # don't care about non-strings
+            if conversion == 'r':
+                item = repr(item)
+            elif conversion == 's':
+                item = str(item)
+            parts.append(format(item, spec))
+        return ''.join(parts)
+
+def _no_tag(tag):
+    return FormatError("Can't format like you want because: "
+                       "there is no tag called '%s'" % tag)
+
+_formats = OrderedDict()
+_formats_lock = threading.Lock()
+FORMAT_CACHE_SIZE = 32
+
+def compile_format(fmt, song_class=Song):
+    """Return a `SongFormat` for `fmt`, reusing a cached one if we can.
+
+    Raises a `FormatError` if `fmt` asks for tags `song_class` doesn't
+    have.
+    """
+    key = (fmt, song_class)
+    with _formats_lock:
+        try:
+            compiled = _formats.pop(key)
+        except KeyError:
+            compiled = None
+        if compiled is not None:
+            _formats[key] = compiled
+            return compiled
+    compiled = SongFormat(fmt, song_class)
+    with _formats_lock:
+        _formats[key] = compiled
+        while len(_formats) > FORMAT_CACHE_SIZE:
+            _formats.popitem(last=False)
+    return compiled
+
+def _path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def _read_song_tags(job):
+    "Process pool worker: return the tags for a (song_class, path) pair"
+    song_class, path = job
+    return song_class(path)._read_tags()
 
 class DoNotExport(Exception):
     "Exception raised by Songs.to_none"
 
+class _Stopped(Exception):
+    """Raised in a worker thread when nobody wants what it's doing: a
+    lazy Songs' parser, a volume being zipped alongside one that
+    failed, or a song being copied after another one failed
+    """
+
 class Songs(object):
     """The main playlist container.
 
     Holds a list of `Song`s, you can `add` playlists or `Song`s, and
     you can `copy_em`, `rename_em` or `zip_em`.
     """
+    # what add_all_songs_below thinks is a song. Subclasses that can
+    # handle more kinds of file can add to it.
+    extensions = frozenset(['mp3', 'ogg', 'oga', 'ogf', 'ogv', 'm4a',
+                            'flac'])
+
     def __init__(self, playlists,
-                 export_type=None, song_class=Song):
+                 export_type=None, song_class=Song,
+                 tag_cache=None, jobs=1, processes=False, dedupe=None,
+                 lazy=False, queue_size=DEFAULT_QUEUE_SIZE,
+                 include=(), exclude=(), progress=None,
+                 pool=None, directories=None):
         """Construct a list of songs from playlists
 
         Argument:
         `playlists`: a string (or list of strings) that are paths to playlist files.
         `song_class`: a Song-compatible class to use instead of the built-in.
+        `tag_cache`: a `TagCache`, or the path to one, that songs will
+                     check before reading tags from their files.
+        `jobs`: how many songs to build at once. With more than one
+                job, songs are created and have their tags read on a
+                pool of worker threads.
+        `processes`: read tags on a pool of `jobs` processes instead of
+                     threads, for when parsing, not I/O, is the problem.
+        `dedupe`: leave out songs that are already in the list. 'path'
+                  means songs with the same path, 'content' means songs
+                  with the same bytes, wherever they are.
+        `lazy`: don't parse anything yet. Playlists are parsed on a
+                background thread the first time the songs are needed,
+                and iterating (so exporting) gets each song as soon as
+                it's been built, instead of after all of them have.
+        `queue_size`: with `lazy`, how many songs can be built ahead
+                      of the one being exported.
+        `include`, `exclude`: glob patterns for `add_all_songs_below`.
+        `progress`: a `progress.Progress` to report what we're up to,
+                    and how long it's taking, to.
+        `pool`: a `multiprocessing.Pool` to read tags (with
+                `processes`) and compress songs on, instead of starting
+                a new one each time.
+        `directories`: a `scanner.DirectoryIndex` to find songs in,
+                       for sharing one between several `Songs`.
         """
         self.Song = song_class
+        if isinstance(tag_cache, basestring):
+            tag_cache = TagCache(tag_cache)
+        self.tag_cache = tag_cache
+        self.jobs = jobs
+        self.processes = processes
+        if dedupe not in (None, 'path', 'content'):
+            raise ValueError("dedupe should be None, 'path' or 'content', not %r"
+                             % (dedupe,))
+        self.dedupe = dedupe
+        # The songs, in order. Add to it with add(), which also keeps
+        # the indexes up to date.
         self.songs = list()
+        self._by_path = dict()
+        # partial digest -> [songs], full digest -> song
+        self._by_partial = dict()
+        self._by_digest = dict()
+        self.lazy = lazy
+        self.queue_size = queue_size
+        self.include = include
+        self.exclude = exclude
+        # with lazy, [addend, songs of it already taken] for each thing
+        # passed to add() that hasn't been parsed yet
+        self._pending = list()
+        # where _add_songs sends songs, when it isn't to _take
+        self._sink = None
+        self.pool = pool
+        # for finding the songs in playlists
+        if directories is None:
+            directories = scanner.DirectoryIndex()
+        self._dirs = directories
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
         self.add(playlists)
         self.export_type = export_type
         if export_type is None:
+            if isinstance(playlists, basestring):
+                playlists = [playlists]
             self.export_type = os.path.splitext(playlists[0])[1][1:]
-            if self.export_type == 'xspf':
-                self.export_type = 'pls'
+
+    @classmethod
+    def batch(cls, jobs, workers=1, processes=False, tag_cache=None,
+              compression=None, progress=None):
+        """Export every one of `jobs` in turn, sharing a process pool,
+        tags and stats between them.
+
+        `jobs`: a list of dicts (or a dict of "jobs" and "defaults") like
+                the JSON in a `batch` manifest.
+        The rest are as for `batch.run`, which this is. Returns its
+        report.
+        """
+        return batch.run(cls, batch.jobs_from(jobs), workers, processes,
+                         tag_cache, compression, progress)
 
     def add(self, addend):
         """Add a addend to the songlist
@@ -243,11 +523,23 @@ class Songs(object):
 
         Returns:
         `self`: for chaining! Although I don't know why you would.
+
+        If the list is `lazy` nothing is parsed until the songs are
+        needed.
         """
+        if self.lazy:
+            self._pending.append([addend, 0])
+        else:
+            self._add(addend)
+        return self
+
+    def _add(self, addend):
         def _getext(path):
             return path[path.rfind('.')+1:]
 
-        if not isinstance(addend, str):
+        if isinstance(addend, Song):
+            addend = [addend]
+        if not isinstance(addend, basestring):
             try:
                 for playlist in addend:
                     if playlist.find('.') == -1:
@@ -258,7 +550,8 @@ class Songs(object):
                         setter(os.path.expanduser(playlist))
             except AttributeError:
                 if isinstance(addend[0], Song):
-                    self.songs.extend(addend)
+                    for song in addend:
+                        self._emit(song, numbered=False)
                 else:
                     raise Exception("I don't know what to do with %s"
                                     % repr(addend))
@@ -273,111 +566,952 @@ class Songs(object):
                                      % _getext(addend))
                     setter(os.path.expanduser(addend))
                 except AttributeError:
-                    if isinstance(addend, Song):
-                        self.songs.extend(addend)
-                    else:
-                        raise Exception("I don't know what to do with %s"
-                                        % repr(addend))
+                    raise Exception("I don't know what to do with %s"
+                                    % repr(addend))
 
-        return self
+    def add_all_songs_below(self, root, include=None, exclude=None):
+        """Add every file below `root` with one of our `extensions`.
 
-    def add_all_songs_below(self, root):
-        for path, dirnames, fnames in os.walk(root):
-            for fname in fnames:
-                name, ext = os.path.splitext(fname)
-                if ext in ('.mp3', '.ogg', '.ogf', '.ogv', '.m4a',
-                           '.flac'):
-                    self.songs.append(self.Song(os.path.join(path, fname)))
+        `include`: glob patterns; if given only files whose path below
+                   root matches one are added. Defaults to the ones
+                   Songs was made with.
+        `exclude`: glob patterns for files and directories to skip.
+        """
+        if include is None:
+            include = self.include
+        if exclude is None:
+            exclude = self.exclude
+        entries = (dict(path=path, stat=st)
+                   for path, st in scanner.scan(root, self.extensions,
+                                                include, exclude,
+                                                self.jobs))
+        self._add_songs(entries, numbered=False)
 
     def zip_em(self, target, inner_dir=None,
-               fmt="{track_number:02} - {artist} - {title}.{ext}"):
+               fmt="{track_number:02} - {artist} - {title}.{ext}",
+               compression=None, update=False, verify=False,
+               max_size=None):
         """Create A ZipFile.
 
         Arguments:
         `target`: the name of the zipfile. If it does not end in
-                  '.zip' that will be added.
+                  '.zip' that will be added. '-' means stdout, and
+                  it can also be a file-like object. Neither have to
+                  be seekable, so pipes and sockets work.
         `inner_dir`: the name of a directory to put everything into
-                     inside of the zip. Defaults to basename(target).
+                     inside of the zip. Defaults to basename(target),
+                     or "songs" if target doesn't have a name.
+        `compression`: a `CompressionPolicy` that decides which songs
+                       get compressed. By default only uncompressed
+                       audio and the playlist are. With more than one
+                       job they're compressed on a process pool.
+        `update`: if target already exists, only add the songs that
+                  aren't in it yet, or have changed since, and take out
+                  the ones that aren't in the playlist anymore.
+                  Members are compared by name, size and modification
+                  time.
+        `verify`: when updating, also compare the CRC of every song
+                  with what's in the archive. This means reading all of
+                  them.
+        `max_size`: split the songs into volumes of at most this many
+                    bytes, TARGET-001.zip, TARGET-002.zip... each with
+                    a playlist of just its own songs. They're planned
+                    from the songs' sizes before anything is written,
+                    and up to `jobs` of them are written at once.
+                    Returns the volumes' paths.
         """
-        target = os.path.expanduser(target)
-        if not target.endswith('.zip'):
-            target += '.zip'
-        if inner_dir is None:
-            inner_dir = os.path.basename(os.path.splitext(target)[0])
+        if target == '-':
+            target = sys.stdout
+        if isinstance(target, basestring):
+            target = os.path.expanduser(target)
+            if not target.endswith('.zip'):
+                target += '.zip'
+            if inner_dir is None:
+                inner_dir = os.path.basename(os.path.splitext(target)[0])
+        elif inner_dir is None:
+            inner_dir = "songs"
+        template = compile_format(fmt, self.Song)
+        if compression is None:
+            compression = CompressionPolicy()
+        if max_size is not None:
+            if not isinstance(target, basestring):
+                raise RuntimeError("Only zip files with names can be "
+                                   "split into volumes")
+            if update:
+                raise RuntimeError("Volumes can't be updated")
+            return self._zip_volumes(target, inner_dir, template, fmt,
+                                     compression, max_size)
+        songs = self
+        zf = None
+        updating = False
+        if update and isinstance(target, basestring) and \
+                os.path.exists(target):
+            try:
+                zf, songs = self._update_zip(target, inner_dir, template,
+                                             verify)
+                updating = True
+            except BadZipfile:
+                print >>sys.stderr, \
+                    "%s isn't a zip file, replacing it" % target
+        if zf is None:
+            zf = ZipWriter(target, self.progress)
+        self._start('zip', songs)
         try:
-            zf = ZipFile(target, 'w')
-            export_func = getattr(self, "to_%s"%self.export_type)
+            for song, st, compress_type, level, deflated in \
+                    self._deflated_songs(compression, songs):
+                self.progress.song(song)
+                arcname = os.path.join(inner_dir,
+                                       self._render(template, song))
+                if deflated is None:
+                    self._zip_song(zf, song, st, arcname, compress_type,
+                                   level)
+                else:
+                    zf.write_deflated(arcname, deflated,
+                                      st.st_mtime, st.st_mode)
+                    self.progress.advance(size=st.st_size)
+                self.progress.advance(1)
+            # the playlist goes last, so that it's the only thing that
+            # has to move when an archive gets updated
             try:
-                zf.writestr("{0}.{1}".format(inner_dir,
-                                             self.export_type) ,
-                            export_func(root=inner_dir,
-                                        fmt=fmt),
-                            )
+                self._zip_playlist(zf, "{0}.{1}".format(inner_dir,
+                                                        self.export_type),
+                                   root=inner_dir, fmt=fmt,
+                                   compression=compression)
             except DoNotExport:
                 pass
-            for i, song in enumerate(self.songs):
-                print "zipping ", song
-                zf.write(song.path,
-                         os.path.join(inner_dir,
-                                      format(song, fmt)))
+        except BaseException:
+            # an archive that was being updated is still a good one
+            # with what's been added so far, a new one that's missing
+            # songs (say a playlist turned out not to exist halfway
+            # through) is no use
+            if not updating:
+                zf.abort()
+            raise
         finally:
             zf.close()
+            self.progress.finish()
+
+    def _update_zip(self, target, inner_dir, template, verify):
+        """Open the zip file `target` to bring it up to date.
+
+        Returns a `ZipWriter` with every member that's still current
+        kept, and a list of the songs that still need to be added.
+        """
+        wanted = dict()
+        for song in self:
+            wanted[os.path.join(inner_dir, self._render(template, song))] = song
+        current = set()
+
+        def keep(info):
+            song = wanted.get(info.filename)
+            if song is None:
+                return False
+            st = os.stat(song.path)
+            if not same_file(info, st):
+                return False
+            if verify:
+                # read it: the cache is keyed on the size and mtime
+                # that same_file has just trusted
+                crc = file_crc(song.path)
+                self._cache_crc(song, st, crc)
+                if info.CRC != crc:
+                    return False
+            current.add(id(song))
+            return True
+
+        zf = ZipWriter.update(target, keep, self.progress)
+        return zf, [song for song in self if id(song) not in current]
+
+    def _zip_song(self, zf, song, st, arcname, compress_type, level):
+        """`zf.write` `song`, with its CRC from the tag cache if it's
+        stored and the cache knows it, and tell the cache the CRC if it
+        didn't.
+        """
+        crc = None
+        if compress_type == ZIP_STORED:
+            crc = self._cached_crc(song, st)
+        written = zf.write(song.path, arcname, compress_type, level,
+                           crc=crc, st=st)
+        if crc is None and compress_type == ZIP_STORED:
+            self._cache_crc(song, st, written)
+
+    def _cached_crc(self, song, st):
+        # tag caches that aren't ours needn't know about CRCs
+        if hasattr(self.tag_cache, 'get_crc'):
+            return self.tag_cache.get_crc(song.path, st)
+        return None
+
+    def _cache_crc(self, song, st, crc):
+        if hasattr(self.tag_cache, 'put_crc'):
+            self.tag_cache.put_crc(song.path, crc, st)
+
+    def _plan_volumes(self, inner_dir, template, compression, max_size):
+        """Split our songs into volumes of at most `max_size` bytes.
+
+        Returns a list of volumes, each a list of (song, arcname,
+        compress_type, level). Sizes are worked out pessimistically,
+        including how much each song could add to the playlist, so
+        volumes come out a little smaller than they have to be.
+        """
+        playlist_type, playlist_level = compression.choose(self.export_type)
+        volumes = list()
+        volume = list()
+        empty = used = END_SIZE + member_size(
+            "%s-000.%s" % (inner_dir, self.export_type),
+            PLAYLIST_HEADER_SIZE, playlist_type)
+        for song in self:
+            size = os.path.getsize(song.path)
+            arcname = os.path.join(inner_dir, self._render(template, song))
+            compress_type, level = compression.choose(song.ext, size)
+            cost = (member_size(arcname, size, compress_type) +
+                    member_size('', _playlist_entry_size(song, arcname),
+                                playlist_type) -
+                    member_size('', 0, playlist_type))
+            if volume and used + cost > max_size:
+                volumes.append(volume)
+                volume = list()
+                used = empty
+            if used + cost > max_size:
+                raise RuntimeError("%s is too big for a %d byte volume"
+                                   % (song.path, max_size))
+            volume.append((song, arcname, compress_type, level))
+            used += cost
+        if volume:
+            volumes.append(volume)
+        return volumes
+
+    def _zip_volumes(self, target, inner_dir, template, fmt, compression,
+                     max_size):
+        "`zip_em` with `max_size`: write the volumes on a pool"
+        volumes = self._plan_volumes(inner_dir, template, compression,
+                                     max_size)
+        base = os.path.splitext(target)[0]
+        paths = ["%s-%03d.zip" % (base, i + 1) for i in range(len(volumes))]
+        stop = threading.Event()
+        self._start('zip')
+        pool = ThreadPool(max(1, min(self.jobs, len(volumes))))
+        try:
+            results = [pool.apply_async(self._zip_volume,
+                                        (path, i + 1, volume, inner_dir,
+                                         fmt, compression, stop))
+                       for i, (path, volume) in enumerate(zip(paths,
+                                                              volumes))]
+            for result in results:
+                result.get()
+        except BaseException:
+            # stop the others, and don't leave any of it behind
+            stop.set()
+            pool.close()
+            pool.join()
+            _remove_all(paths)
+            raise
+        finally:
+            pool.terminate()
+            self.progress.finish()
+        return paths
+
+    def _zip_volume(self, path, number, volume, inner_dir, fmt,
+                    compression, stop):
+        """Write the volume `path`, numbered `number`.
+
+        `volume` is one of the lists `_plan_volumes` returns, and it's
+        abandoned if `stop` gets set.
+        """
+        zf = ZipWriter(path, self.progress)
+        try:
+            for song, arcname, compress_type, level in volume:
+                if stop.is_set():
+                    raise _Stopped()
+                self.progress.song(song)
+                self._zip_song(zf, song, os.stat(song.path), arcname,
+                               compress_type, level)
+                self.progress.advance(1)
+            # just this volume's songs, but everything else ours
+            songs = type(self)([song for song, _, _, _ in volume],
+                               export_type=self.export_type,
+                               song_class=self.Song,
+                               tag_cache=self.tag_cache,
+                               progress=self.progress,
+                               directories=self._dirs)
+            try:
+                songs._zip_playlist(zf, "%s-%03d.%s" % (inner_dir, number,
+                                                        self.export_type),
+                                    root=inner_dir, fmt=fmt,
+                                    compression=compression)
+            except DoNotExport:
+                pass
+        except BaseException:
+            zf.abort()
+            raise
+        zf.close()
+
+    def _deflated_songs(self, compression, songs=None):
+        """Yield (song, stat, compress_type, level, deflated) in order.
+
+        With more than one job, songs that `compression` says should be
+        deflated are deflated on a process pool, a few songs ahead of
+        the one being yielded, and `deflated` is what `deflate_file`
+        returned for them. Otherwise it's None and the song still needs
+        compressing.
+
+        `songs`: the songs to go through, if not all of them.
+        """
+        if songs is None:
+            songs = self
+        if self.jobs <= 1:
+            for song in songs:
+                st = os.stat(song.path)
+                yield (song, st) + compression.choose(song.ext, st.st_size) \
+                    + (None,)
+            return
+
+        pool = None
+        pending = deque()
+        in_flight = 0
+        try:
+            for song in songs:
+                st = os.stat(song.path)
+                compress_type, level = compression.choose(song.ext,
+                                                          st.st_size)
+                result = None
+                if compress_type == ZIP_DEFLATED:
+                    if pool is None:
+                        pool = self.pool or multiprocessing.Pool(self.jobs)
+                    result = pool.apply_async(deflate_file,
+                                              (song.path, level))
+                    in_flight += 1
+                pending.append((song, st, compress_type, level, result))
+                # keep every worker busy, but don't let finished
+                # members pile up in memory
+                while in_flight > 2 * self.jobs:
+                    item = pending.popleft()
+                    if item[-1] is not None:
+                        in_flight -= 1
+                        with self.progress.timer('compress'):
+                            item = item[:-1] + (item[-1].get(),)
+                    yield item
+            while pending:
+                item = pending.popleft()
+                if item[-1] is not None:
+                    with self.progress.timer('compress'):
+                        item = item[:-1] + (item[-1].get(),)
+                yield item
+        finally:
+            if pool is not None and pool is not self.pool:
+                pool.terminate()
 
     def copy_em(self, target,
-                fmt="{track_number:02} - {artist} - {title}.{ext}"):
+                fmt="{track_number:02} - {artist} - {title}.{ext}",
+                strategy=transfer.DEFAULT_STRATEGY,
+                sync=False, verify=False, prune=False):
+        """Copy songs into a directory.
+
+        Arguments:
+        `target`: the directory to copy them into. It's created if it
+                  doesn't exist, and the playlist goes next to it.
+        `strategy`: how to copy them, one of `transfer.STRATEGIES`:
+                    'fast' tries reflinks and copy_file_range before
+                    actually copying, 'hardlink' tries hard links
+                    before that, and 'copy' just copies.
+        `sync`: don't copy songs that are already in target with the
+                same size and modification time.
+        `verify`: with `sync`, also compare the contents of songs that
+                  look the same.
+        `prune`: delete files in target that aren't in the playlist.
+
+        With more than one job, that many songs are copied at once.
+
+        If it's cancelled (see `progress.Progress.cancel`), the songs
+        it had copied so far, and target if it made it, are removed.
+
+        Returns a `transfer.Summary` of what was copied, skipped and
+        removed.
+        """
+        template = compile_format(fmt, self.Song)
         target = os.path.expanduser(target)
+        made_target = False
         if not os.path.exists(target):
             os.makedirs(target)
+            made_target = True
         elif not os.path.isdir(target):
             sys.exit("Trying to copy files into non-directory. Quitting")
 
+        copies = ((song, os.path.join(target, self._render(template, song)))
+                  for song in self)
+        wanted = set()
+        # files that weren't there before we copied them, to take out
+        # again if we're cancelled
+        created = list()
+        summary = transfer.Summary()
+        # set when the copying has failed, so the rest don't start
+        stop = threading.Event()
+        def copy(job):
+            if stop.is_set():
+                raise _Stopped()
+            song, dst = job
+            src = song.path
+            self.progress.song(song)
+            wanted.add(_fs_path(os.path.abspath(dst)))
+            size = os.path.getsize(src)
+            try:
+                if sync:
+                    with self.progress.timer('read'):
+                        if transfer.up_to_date(src, dst, verify):
+                            return 'skipped', size
+                with self.progress.timer('write'):
+                    if not os.path.lexists(dst):
+                        created.append(dst)
+                    transfer.transfer(src, dst, strategy)
+                return 'copied', size
+            finally:
+                self.progress.advance(1, size)
+        self._start('copy')
         try:
-            with open(os.path.join(os.path.dirname(target),
-                                   "{0}.{1}".format(os.path.basename(target),
-                                                    self.export_type)), 'w') as fh:
-                fh.write(getattr(self, "to_%s" % self.export_type)())
-        except DoNotExport:
-            pass
-        for i, song in enumerate(self.songs):
-            shutil.copy(song.path,
-                        os.path.join(target,
-                                     format(song,
-                                            fmt)))
+            if self.jobs <= 1:
+                for job in copies:
+                    summary.add(*copy(job))
+            else:
+                pool = ThreadPool(self.jobs)
+                # fed from this thread, like _build_songs, so that a
+                # song that can't be named (or a playlist that can't be
+                # parsed) raises here instead of in the pool's own
+                # thread, where it would leave join() waiting for good
+                pending = deque()
+                try:
+                    for job in copies:
+                        pending.append(pool.apply_async(copy, (job,)))
+                        while len(pending) > 2 * self.jobs:
+                            summary.add(*pending.popleft().get())
+                    while pending:
+                        summary.add(*pending.popleft().get())
+                except BaseException:
+                    stop.set()
+                    raise
+                finally:
+                    # terminate() doesn't wait for the copies already
+                    # going, which have to be finished before they can
+                    # be cleaned up after
+                    pool.close()
+                    pool.join()
+        except (Cancelled, KeyboardInterrupt):
+            _remove_all(created, made_target and target)
+            raise
+        finally:
+            self.progress.finish()
+        # after the songs, so that a lazy list has been parsed
+        self._copy_playlist(target, fmt)
+
+        if prune:
+            # bytes, like wanted
+            for path, dirnames, fnames in os.walk(_fs_path(target)):
+                for fname in fnames:
+                    fname = os.path.abspath(os.path.join(path, fname))
+                    if fname not in wanted:
+                        size = os.path.getsize(fname)
+                        os.remove(fname)
+                        summary.add('removed', size)
+        return summary
+
+    def export(self, zip_target=None, copy_target=None, manifest=None,
+               fmt="{track_number:02} - {artist} - {title}.{ext}",
+               inner_dir=None, compression=None, digest='sha1'):
+        """Zip, copy and/or checksum songs, reading each of them once.
+
+        Every song is read in big chunks, and each chunk goes to every
+        one of the outputs asked for before the next one is read.
+
+        Arguments:
+        `zip_target`: a zip file to write, like `zip_em`'s target.
+        `copy_target`: a directory to copy into, like `copy_em`'s.
+        `manifest`: a path or file object to write a checksum for each
+                    song to, in the format `sha1sum -c` understands.
+        `inner_dir`, `compression`: as for `zip_em`.
+        `digest`: the hashlib algorithm to use for the manifest.
+
+        If it's cancelled or fails, whatever it had written so far is
+        removed.
+        """
+        template = compile_format(fmt, self.Song)
+        if compression is None:
+            compression = CompressionPolicy()
+        zf = copy_dir = manifest_fh = None
+        made_copy_dir = False
+        created = list()
+        sinks = ()
+        hasher = member = None
+        try:
+            if zip_target is not None:
+                if zip_target == '-':
+                    zip_target = sys.stdout
+                if isinstance(zip_target, basestring):
+                    zip_target = os.path.expanduser(zip_target)
+                    if not zip_target.endswith('.zip'):
+                        zip_target += '.zip'
+                    if inner_dir is None:
+                        inner_dir = os.path.basename(
+                            os.path.splitext(zip_target)[0])
+                elif inner_dir is None:
+                    inner_dir = "songs"
+                zf = ZipWriter(zip_target, self.progress)
+            if copy_target is not None:
+                copy_dir = os.path.expanduser(copy_target)
+                if not os.path.isdir(copy_dir):
+                    os.makedirs(copy_dir)
+                    made_copy_dir = True
+            if isinstance(manifest, basestring):
+                manifest_fh = open(os.path.expanduser(manifest), 'w')
+                created.append(manifest_fh.name)
+            elif manifest is not None:
+                manifest_fh = manifest
+
+            self._start('export')
+            timer = self.progress.timer
+            for song in self:
+                self.progress.song(song)
+                name = self._render(template, song)
+                st = os.stat(song.path)
+                sinks = list()
+                member = None
+                if zf is not None:
+                    member = zf.open(os.path.join(inner_dir, name),
+                                     *compression.choose(song.ext,
+                                                         st.st_size),
+                                     mtime=st.st_mtime,
+                                     mode=st.st_mode,
+                                     size=st.st_size)
+                    sinks.append(member)
+                if copy_dir is not None:
+                    dst = os.path.join(copy_dir, name)
+                    if not os.path.lexists(dst):
+                        created.append(dst)
+                    sinks.append(open(dst, 'wb'))
+                hasher = None
+                if manifest_fh is not None:
+                    hasher = hashlib.new(digest)
+                    sinks.append(hasher)
+                with open(song.path, 'rb') as fh:
+                    while True:
+                        with timer('read'):
+                            chunk = fh.read(FANOUT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        for sink in sinks:
+                            if sink is hasher:
+                                with timer('compress'):
+                                    sink.update(chunk)
+                            elif sink is member:
+                                # which times itself
+                                sink.write(chunk)
+                            else:
+                                with timer('write'):
+                                    sink.write(chunk)
+                        self.progress.advance(size=len(chunk))
+                for sink in sinks:
+                    if sink is not hasher:
+                        sink.close()
+                sinks = ()
+                if copy_dir is not None:
+                    shutil.copystat(song.path, os.path.join(copy_dir, name))
+                if hasher is not None:
+                    manifest_fh.write("%s  %s\n" % (hasher.hexdigest(),
+                                                    _encode(name)))
+                self.progress.advance(1)
+
+            if copy_dir is not None:
+                self._copy_playlist(copy_dir, fmt)
+            if zf is not None:
+                try:
+                    self._zip_playlist(zf, "{0}.{1}".format(inner_dir,
+                                                            self.export_type),
+                                       root=inner_dir, fmt=fmt,
+                                       compression=compression)
+                except DoNotExport:
+                    pass
+        except BaseException:
+            # a half written zip file, copy or manifest is no use
+            if zf is not None:
+                zf.abort()
+            for sink in sinks:
+                if sink is not hasher and sink is not member:
+                    sink.close()
+            sinks = ()
+            if manifest_fh is not None and manifest_fh is not manifest:
+                manifest_fh.close()
+            _remove_all(created, made_copy_dir and copy_dir)
+            raise
+        finally:
+            for sink in sinks:
+                if sink is not hasher and sink is not member:
+                    sink.close()
+            if zf is not None:
+                zf.close()
+            if manifest_fh is not None and manifest_fh is not manifest:
+                manifest_fh.close()
+            self.progress.finish()
 
     def rename_em(self, target=None,
-                  fmt="{track_number:02} - {artist} - {title}.{ext}"):
+                  fmt="{track_number:02} - {artist} - {title}.{ext}",
+                  journal=None):
         """Rename song files based on metadata.
 
+        Every new name is worked out before anything is renamed, and if
+        two songs would get the same name, or a song would overwrite
+        some other file, a `renamer.RenameCollision` is raised instead.
+
         Arguments:
             target -- the directory to move files to. The default is to
                       rename files in place.
+            journal -- a file to write the plan and progress to, so
+                       that `renamer.resume` can finish an interrupted
+                       batch and `renamer.rollback` can undo it.
+        """
+        template = compile_format(fmt, self.Song)
+        if target is not None:
+            target = os.path.expanduser(target)
+            if not os.path.exists(target):
+                os.makedirs(target)
+        moves = list()
+        self._start('rename')
+        try:
+            for song in self:
+                self.progress.song(song)
+                dirname = target
+                if dirname is None:
+                    dirname = os.path.dirname(song.path)
+                moves.append((song.path,
+                              os.path.join(dirname,
+                                           self._render(template, song))))
+            renamer.rename(moves, journal, max(self.jobs, 1), self.progress)
+        finally:
+            self.progress.finish()
+
+    def _start(self, task, songs=None):
+        "Tell our progress that we're starting `task` on `songs` (or all)"
+        if songs is None or songs is self:
+            self.progress.start(task, len(self.songs),
+                                counting=bool(self._pending))
+        else:
+            self.progress.start(task, len(songs))
+
+    def _render(self, template, song):
+        """Return `template.render(song)`.
+
+        Reading the song's tags, if that's what it takes, is timed
+        separately from formatting.
+        """
+        if template.needs_tags and not song._tags_loaded:
+            with self.progress.timer('tags'):
+                song._load_tags()
+        with self.progress.timer('format'):
+            return template.render(song)
+
+    def _make_song(self, *args, **kwargs):
+        "Build a song that knows about our tag cache"
+        if self.tag_cache is not None:
+            kwargs['tag_cache'] = self.tag_cache
+        return self.Song(*args, **kwargs)
+
+    def _add_songs(self, entries, numbered=True):
+        """Build songs out of `entries` and append them.
+
+        Arguments:
+        `entries`: an iterable of dicts of keyword arguments for `Song`.
+        `numbered`: give each song the track number of its position in
+                    the list, counting only songs that could be added.
+        """
+        entries = self.progress.timed('parse', entries)
+        for song in self._build_songs(entries):
+            self._emit(song, numbered)
+
+    def _emit(self, song, numbered):
+        "Hand a freshly built song to whoever is collecting them"
+        if self._sink is not None:
+            return self._sink(song, numbered)
+        return self._take(song, numbered)
+
+    def _take(self, song, numbered):
+        "Append `song`, numbering it first if it should be"
+        if numbered:
+            song.track_number = len(self.songs) + 1
+        if self._append(song):
+            self.progress.found()
+            return True
+        return False
+
+    def _append(self, song):
+        """Add `song` to the end of the list, and to the indexes.
+
+        Returns False, without adding it, if `dedupe` says that it's
+        already there.
+        """
+        path_key = _path_key(song.path)
+        if self.dedupe is not None and path_key in self._by_path:
+            return False
+        if self.dedupe == 'content':
+            partial = transfer.partial_digest(song.path)
+            same = self._by_partial.setdefault(partial, list())
+            if same:
+                if len(same) == 1:
+                    # now there could be a duplicate, so the first song
+                    # with this partial digest needs a full one, too
+                    self._by_digest[transfer.file_digest(same[0].path)] = \
+                        same[0]
+                digest = transfer.file_digest(song.path)
+                if digest in self._by_digest:
+                    return False
+                self._by_digest[digest] = song
+            same.append(song)
+        self.songs.append(song)
+        self._by_path.setdefault(path_key, song)
+        return True
+
+    def _build_songs(self, entries):
+        """Yield a song for every entry that exists, in order.
+
+        With more than one job the songs are built, and have their tags
+        read, on a worker pool.
+        """
+        if self.jobs <= 1:
+            for entry in entries:
+                song = self._try_song(entry)
+                if song is not None:
+                    yield song
+            return
+
+        pool = ThreadPool(self.jobs)
+        load = partial(self._try_song, load_tags=not self.processes)
+
+        def built():
+            # like imap, but without reading all of entries up front
+            pending = deque()
+            for entry in entries:
+                pending.append(pool.apply_async(load, (entry,)))
+                while len(pending) > 2 * self.jobs:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        try:
+            songs = built()
+            if self.processes:
+                songs = self._load_tags_in_processes(songs)
+            for song in songs:
+                if song is not None:
+                    yield song
+        finally:
+            pool.terminate()
+
+    def _try_song(self, entry, load_tags=False):
+        """Return a song for `entry`, or None if it can't be found.
+
+        Entries that haven't already been found on disk are looked up
+        in our `scanner.DirectoryIndex`, which also finds songs whose
+        path has the wrong case or backslashes in it.
         """
-        empty_target = False
-        for i, song in enumerate(self.songs):
-            if target is None:
-                target = os.path.dirname(song.path)
-                empty_target = True
+        if 'stat' not in entry and not entry.get('exists'):
+            with self.progress.timer('parse'):
+                path = self._dirs.resolve(entry['path'])
+            if path is None:
+                print >>sys.stderr, "could not add %s: Does not Exist" \
+                    % entry['path']
+                return None
+            entry = dict(entry, path=path, exists=True)
+        try:
+            song = self._make_song(**entry)
+        except OSError, e:
+            print >>sys.stderr, "could not add %s: %s" % (entry['path'], e)
+            return None
+        if load_tags:
+            with self.progress.timer('tags'):
+                song._load_tags()
+        return song
+
+    def _load_tags_in_processes(self, songs):
+        """Yield `songs`, in order, with their tags read on a process pool.
+
+        Tags that are in the tag cache are taken from there instead.
+        Songs go to the pool in batches of `TAG_BATCH_SIZE`, and only a
+        few batches are read ahead of the song being yielded.
+        """
+        pool = self.pool or multiprocessing.Pool(self.jobs)
+        pending = deque()   # (batch, unread songs, result), in order
+
+        def submit(batch):
+            unread = list()
+            for song in batch:
+                tags = None
+                if self.tag_cache is not None:
+                    tags = self.tag_cache.get(song.path, song._stat)
+                if tags is None:
+                    unread.append(song)
+                else:
+                    song._set_tags(tags)
+            result = None
+            if unread:
+                result = pool.map_async(_read_song_tags,
+                                        [(type(song), song.path)
+                                         for song in unread])
+            pending.append((batch, unread, result))
+
+        def finish():
+            batch, unread, result = pending.popleft()
+            if result is not None:
+                with self.progress.timer('tags'):
+                    tags = result.get()
+                for song, tags in zip(unread, tags):
+                    if self.tag_cache is not None and MUTAGEN:
+                        self.tag_cache.put(song.path, tags, song._stat)
+                    song._set_tags(tags)
+            return batch
+
+        try:
+            batch = list()
+            for song in songs:
+                if song is None:
+                    continue
+                batch.append(song)
+                if len(batch) == TAG_BATCH_SIZE:
+                    submit(batch)
+                    batch = list()
+                    while len(pending) > 2 * self.jobs:
+                        for done in finish():
+                            yield done
+            if batch:
+                submit(batch)
+            while pending:
+                for done in finish():
+                    yield done
+        finally:
+            if pool is not self.pool:
+                pool.terminate()
+
+    def _parse_pending(self):
+        """Yield songs from the playlists lazy `add`s put off, as they're
+        built.
+
+        The parsing happens on another thread, which gets at most
+        `queue_size` songs ahead. The songs are appended as they're
+        yielded, so once this is done the list is complete. If it's
+        stopped early, whatever hasn't been taken yet is put back to be
+        parsed next time.
+        """
+        pending, self._pending = self._pending, list()
+        queue = Queue.Queue(self.queue_size)
+        stopped = threading.Event()
+        done, failed = object(), object()
+        # the addend being parsed, and how many of its songs to skip
+        # because an earlier, interrupted parse already took them
+        emitting = [0, 0]
+        taken = [skip for addend, skip in pending]
+        last = 0
+
+        def put(item):
+            # give up if the songs aren't wanted anymore, instead of
+            # waiting forever for room
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+            raise _Stopped()
+
+        def sink(song, numbered):
+            if emitting[1]:
+                emitting[1] -= 1
+            else:
+                put((emitting[0], song, numbered))
+            return True
 
-            shutil.move(song.path,
-                        os.path.join(target, format(song, fmt)))
+        def parse():
+            self._sink = sink
+            try:
+                try:
+                    for i, (addend, skip) in enumerate(pending):
+                        emitting[:] = [i, skip]
+                        self._add(addend)
+                except _Stopped:
+                    return
+                except BaseException:
+                    put((failed, sys.exc_info()))
+                    return
+                put(done)
+            except _Stopped:
+                pass
+            finally:
+                self._sink = None
 
-            if empty_target:
-                target = None
+        parser = threading.Thread(target=parse, name="zipls-parser")
+        parser.daemon = True
+        parser.start()
+        try:
+            while True:
+                try:
+                    # with a timeout, so that ^C still works
+                    item = queue.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                if item is done:
+                    pending = list()
+                    if not self._pending:
+                        self.progress.done_counting()
+                    break
+                if item[0] is failed:
+                    raise item[1][0], item[1][1], item[1][2]
+                last, song, numbered = item
+                taken[last] += 1
+                if self._take(song, numbered):
+                    yield song
+        finally:
+            stopped.set()
+            parser.join()
+            self._pending[:0] = [[addend, taken[i]]
+                                 for i, (addend, skip) in enumerate(pending)
+                                 if i >= last]
+
+    def _finish_parsing(self):
+        "Parse anything a lazy `add` put off"
+        while self._pending:
+            for song in self._parse_pending():
+                pass
 
     ################################################################
     # Container Emulation
     def __iter__(self):
-        return self.songs.__iter__()
+        if not self._pending:
+            return self.songs.__iter__()
+        return self._iter_lazily()
+
+    def _iter_lazily(self):
+        for song in list(self.songs):
+            yield song
+        while self._pending:
+            for song in self._parse_pending():
+                yield song
+
+    def __contains__(self, item):
+        "Is `item` (a song or the path to one) in the list?"
+        self._finish_parsing()
+        if isinstance(item, Song):
+            item = item.path
+        return _path_key(item) in self._by_path
 
     def __getitem__(self, key):
+        self._finish_parsing()
         return self.songs[key]
 
     def __len__(self):
+        self._finish_parsing()
         return len(self.songs)
 
     ################################################################
     # Playlist Parsers
+    #
+    # Each _songs_from_EXT hands _add_songs a generator of the Song
+    # arguments for every entry in the playlist, in order.
     def _songs_from_pls(self, playlist):
+        self._add_songs(self._entries_from_pls(playlist))
+
+    def _entries_from_pls(self, playlist):
         root = os.path.dirname(playlist)
         with open(playlist, 'rU') as fh:
             path = ""
@@ -385,36 +1519,61 @@ class Songs(object):
             for line in fh:
                 line = line.rstrip()
                 if '=' in line and line.startswith("File"):
-                    path = os.path.join(root, line.split('=')[1])
+                    path = os.path.join(root, line.split('=', 1)[1])
                 elif '=' in line and line.startswith("Title"):
-                    title = line.split('=')[1]
-                    try:
-                        self.songs.append(self.Song(path, title,
-                                                    track_number=len(self)+1))
-                    except OSError:
-                        print "could not add %s" % path
+                    title = line.split('=', 1)[1]
+                    yield dict(path=path, title=title)
 
     def _songs_from_xspf(self, playlist):
-        def get_tag(element, tagname):
-            h = HTMLParser()
-            return h.unescape(element.getElementsByTagName(tagname)[0].firstChild.toxml())
-        root = os.path.dirname(playlist)
-        dom = minidom.parse(playlist)
-        for e in dom.getElementsByTagName('track'):
-            title = get_tag(e, 'title')
-            path = os.path.join(root, get_tag(e, 'location'))
-            try:
-                artist = get_tag(e, 'creator')
-            except:
-                artist = None
-            try:
-                self.songs.append(self.Song(path, title, artist,
-                                            track_number=len(self)+1))
-            except OSError:
-                print "could not add %s" % path
+        self._add_songs(self._entries_from_xspf(playlist))
+
+    def _entries_from_xspf(self, playlist):
+        """Yield an entry per <track>, as each one is parsed.
 
+        Each track is thrown away once it's been read, so this takes
+        the same memory no matter how big the playlist is.
+        """
+        def local(tag):
+            # drop the namespace: {http://xspf.org/ns/0/}track -> track
+            return tag[tag.rfind('}')+1:]
+
+        root = os.path.dirname(playlist)
+        parents = list()
+        for event, element in iterparse(playlist, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if local(element.tag) != 'track':
+                continue
+
+            tags = dict()
+            for child in element:
+                tag = local(child.tag)
+                if tag not in tags and child.text:
+                    tags[tag] = child.text.strip()
+            # we're done with it, don't let it pile up
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+
+            if 'location' not in tags:
+                continue
+            entry = dict(path=_xspf_location(root, tags['location']),
+                         title=tags.get('title'),
+                         artist=tags.get('creator'),
+                         album=tags.get('album'))
+            if 'duration' in tags:
+                try:
+                    entry['length'] = int(tags['duration']) // 1000
+                except ValueError:
+                    pass
+            yield entry
 
     def _songs_from_m3u(self, playlist):
+        self._add_songs(self._entries_from_m3u(playlist))
+
+    def _entries_from_m3u(self, playlist):
         root = os.path.dirname(playlist)
         artist = title = path = time = None
         with open(playlist, 'rU') as fh:
@@ -430,64 +1589,185 @@ class Songs(object):
                             artist = None
                     elif not line.startswith('#') and len(line) > 0:
                         path = os.path.join(root, line)
-                        try:
-                            self.songs.append(self.Song(path=path, title=title,
-                                                        artist=artist,
-                                                        length=time,
-                                                        track_number=len(self)+1))
-                        except OSError, e:
-                            print "could not add %s: %s" % (path, e)
+                        yield dict(path=path, title=title,
+                                   artist=artist, length=time)
                         artist = title = path = None
             else:
                 fh.seek(0)
                 for line in fh:
-                    try:
-                        self.songs.append(self.Song(line.strip()),
-                                          track_number=len(self)+1)
-                    except OSError, e:
-                        print "could not add %s: %s" % (path, e)
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        yield dict(path=os.path.join(root, line))
 
     ################################################################
     # Playlist Writers
+    #
+    # write_EXT(fh, root, fmt) streams a playlist of type EXT into the
+    # file-like `fh` one entry at a time. to_EXT returns the same thing
+    # as a string.
+    def _playlist_writer(self):
+        return getattr(self, "write_%s" % self.export_type)
+
+    def _copy_playlist(self, target, fmt):
+        "Write our playlist next to the directory `target`"
+        write_playlist = self._playlist_writer()
+        playlist = os.path.join(os.path.dirname(target),
+                                "{0}.{1}".format(os.path.basename(target),
+                                                 self.export_type))
+        try:
+            with open(playlist, 'w') as fh:
+                write_playlist(fh, root=os.path.basename(target), fmt=fmt)
+        except DoNotExport:
+            os.remove(playlist)
+
+    def _zip_playlist(self, zf, name, root, fmt, compression):
+        "Stream our playlist into the `ZipWriter` `zf` as `name`"
+        write_playlist = self._playlist_writer()
+        if write_playlist == self.write_none:
+            raise DoNotExport()
+        with zf.open(name, *compression.choose(self.export_type)) as fh:
+            write_playlist(fh, root=root, fmt=fmt)
+
+    def write_none(self, *a, **kw):
+        raise DoNotExport()
+
     def to_none(self, *a, **kw):
         raise DoNotExport()
 
+    def write_pls(self, fh,
+                  root="",
+                  fmt="{track_number:02} - {artist} - {title}.{ext}"):
+        template = compile_format(fmt, self.Song)
+        fh.write("[playlist]\n"
+                 "NumberOfEntries=%d\n" % len(self))
+        for i, song in enumerate(self):
+            fh.write("\nFile%d=%s\n"
+                     "Title%d=%s\n"
+                     "Length%d=%s\n" % (
+                    i+1, _encode(os.path.join(root, template.render(song))),
+                    i+1, _encode(song.title),
+                    i+1, _encode(song.length)))
+
     def to_pls(self,
                root="",
                fmt="{track_number:02} - {artist} - {title}.{ext}"):
-        buf = "[playlist]\n"
-        buf += "NumberOfEntries=%d\n\n" % len(self)
+        buf = StringIO()
+        self.write_pls(buf, root, fmt)
+        return buf.getvalue()
 
-        for i, song in enumerate(self):
-            try:
-                buf += "File{track_number}:{path}\n"\
-                       "Title{track_number}:{title}\n"\
-                       "Length{track_number}:{length}\n\n".format(
-                    track_number=i+1,
-                    path=os.path.join(root,
-                                      format(song, fmt)),
-                    title=song.title,
-                    length=song.length
-                    )
-            except KeyError, e:
-                print e
-                import pdb; pdb.set_trace()
-        buf = buf[:-1]
-        return buf
+    def write_m3u(self, fh,
+                  root="",
+                  fmt="{track_number:02} - {artist} - {title}.{ext}"):
+        template = compile_format(fmt, self.Song)
+        fh.write("#EXTM3U\n")
+        for song in self:
+            name = _encode(song.title)
+            if song.artist:
+                name = _encode(song.artist) + " - " + name
+            fh.write("\n#EXTINF:%s,%s\n"
+                     "%s\n" % (_encode(song.length), name,
+                               _encode(os.path.join(root,
+                                                    template.render(song)))))
 
     def to_m3u(self,
                root="",
                fmt="{track_number:02} - {artist} - {title}.{ext}"):
-        buf = "#EXTM3U\n\n"
+        buf = StringIO()
+        self.write_m3u(buf, root, fmt)
+        return buf.getvalue()
+
+    def write_xspf(self, fh,
+                   root="",
+                   fmt="{track_number:02} - {artist} - {title}.{ext}"):
+        template = compile_format(fmt, self.Song)
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+                 '  <trackList>\n')
+        for i, song in enumerate(self):
+            location = urllib.quote(_encode(os.path.join(root,
+                                                         template.render(song))))
+            fh.write('    <track>\n'
+                     '      <location>%s</location>\n' % escape(location))
+            for tag, value in (('title', song.title),
+                               ('creator', song.artist),
+                               ('album', song.album)):
+                if value:
+                    fh.write('      <%s>%s</%s>\n'
+                             % (tag, escape(_encode(value)), tag))
+            fh.write('      <trackNum>%d</trackNum>\n' % (i+1))
+            try:
+                length = int(float(song.length))
+            except ValueError:
+                length = -1
+            if length > 0:
+                fh.write('      <duration>%d</duration>\n' % (length * 1000))
+            fh.write('    </track>\n')
+        fh.write('  </trackList>\n'
+                 '</playlist>\n')
+
+    def to_xspf(self,
+                root="",
+                fmt="{track_number:02} - {artist} - {title}.{ext}"):
+        buf = StringIO()
+        self.write_xspf(buf, root, fmt)
+        return buf.getvalue()
 
-        for song in self:
-            buf += "#EXTINF:{song.length}:{song.artist} - {song.title}\n"\
-                   "{path}\n\n".format(
-                song=song,
-                path=os.path.join(root,
-                                  format(song, fmt)),
-                )
-        return buf[:-1]
+def _xspf_location(root, location):
+    """Turn an xspf <location> (a URI) into a path.
+
+    file:// URIs are absolute, anything else is relative to `root`, the
+    directory the playlist is in.
+    """
+    if isinstance(location, unicode):
+        # so that unquoting gives utf-8 bytes, not mojibake
+        location = location.encode('utf-8')
+    uri = urlparse(location)
+    if uri.scheme == 'file':
+        path = urllib.url2pathname(uri.path)
+        if uri.netloc and uri.netloc != 'localhost':
+            # file://server/share/song.mp3
+            path = '//' + uri.netloc + path
+        return path
+    return os.path.join(root, urllib.url2pathname(location))
+
+def _encode(thing):
+    "Return `thing` as a utf-8 encoded str, for writing into playlists"
+    if isinstance(thing, unicode):
+        return thing.encode('utf-8')
+    return str(thing)
+
+def _playlist_entry_size(song, arcname):
+    """The most that `song`, zipped as `arcname`, could add to a
+    playlist of any kind: its path quoted for a url, and its tags
+    escaped for xml.
+    """
+    tags = sum(len(_encode(value))
+               for value in (song.title, song.artist, song.album,
+                             song.length))
+    return 3 * len(_encode(arcname)) + 5 * tags + 160
+
+def _fs_path(path):
+    """`path` as the byte string that `os.walk` and `os.listdir` give
+    back for it. Tags are unicode, so the names made from them can be.
+    """
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+def _remove_all(paths, directory=None):
+    """Remove the files in `paths`, and then `directory` if it's empty,
+    for cleaning up after a cancelled export.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    if directory:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
 
 #######################################################################
 ## Script Logic
@@ -517,7 +1797,8 @@ still meaningful.
     parser.add_argument('playlist', nargs='*',
                         help="\nthe playlist files to use to decide where to get the music from\n")
     parser.add_argument('-t', '--target', help="The file to write the music to.\n"
-                        "(Defaults to the (first) playlist filename, with .zip instead of .pls)\n")
+                        "(Defaults to the (first) playlist filename, with .zip instead of .pls)\n"
+                        "'-' writes the zip file to stdout as it's made.\n")
     parser.add_argument('-i', '--inner-folder-name',
                         help="An internal folder name to put the music files inside of.\n"
                         "(Defaults to the name of the archive, minus 'zip'.)\n")
@@ -525,6 +1806,28 @@ still meaningful.
                         help="\nCopy files into a directory instead of zipping them.\n"
                         "(Target is a destination folder to copy them in this case.\n"
                         "Creates the folder if it doesn't exist)")
+    parser.add_argument('--copy-method', action='store',
+                        choices=sorted(transfer.STRATEGIES),
+                        default=transfer.DEFAULT_STRATEGY,
+                        help="How --copy copies files: 'fast' uses copy-on-write clones or\n"
+                        "in-kernel copies where the filesystem can, 'hardlink' links\n"
+                        "files on the same filesystem, 'copy' always copies.\n"
+                        "(Default: %(default)s)")
+    parser.add_argument('--sync', action='store_true', default=False,
+                        help="With --copy, skip songs that are already in the target folder\n"
+                        "with the same size and modification time.")
+    parser.add_argument('--prune', action='store_true', default=False,
+                        help="With --copy, delete files in the target folder that aren't\n"
+                        "in the playlist.")
+    parser.add_argument('--also-copy', action='store', metavar='DIR', default=None,
+                        help="While zipping, also copy the songs into DIR. Each song is only\n"
+                        "read once, and compressed as it's read rather than on --jobs\n"
+                        "processes.")
+    parser.add_argument('--manifest', action='store', metavar='PATH', default=None,
+                        help="Write the sha1 of every song to PATH (in `sha1sum -c` format)\n"
+                        "while zipping or copying them. Like --also-copy, it can't be\n"
+                        "used with --sync, --prune, --update, --verify, --max-size or\n"
+                        "--copy-method.")
     parser.add_argument('--rename', action='store_true', default=False,
                         help="Rename files instead of copying them.\n"
                         "This is useful if you've got some files with bad filenames but good tags.\n"
@@ -536,6 +1839,24 @@ still meaningful.
     #                     help="Change song metadata so that it will show up in media\n"
     #                     "players in the correct order and with the album changed to\n"
     #                     "the playlist name")
+    parser.add_argument('--journal', action='store', metavar='PATH', default=None,
+                        help="With --rename, keep track of what's been renamed in PATH, so that\n"
+                        "an interrupted run can be finished with --resume-renames PATH, or\n"
+                        "undone with --rollback-renames PATH.")
+    parser.add_argument('--resume-renames', action='store', metavar='PATH',
+                        default=None,
+                        help="Finish the renames in the journal at PATH.")
+    parser.add_argument('--batch', action='store', metavar='MANIFEST',
+                        default=None,
+                        help="Run every job in the JSON file MANIFEST ('-' for stdin),\n"
+                        "sharing tags and workers between them, instead of exporting\n"
+                        "the playlists given. See zipls/batch.py for what it looks like.")
+    parser.add_argument('--report', action='store', metavar='PATH', default='-',
+                        help="Where --batch writes how each job went, as JSON.\n"
+                        "(Default: stdout)")
+    parser.add_argument('--rollback-renames', action='store', metavar='PATH',
+                        default=None,
+                        help="Undo the renames in the journal at PATH.")
     parser.add_argument('-f', '--format',
                         action='store',
                         default="{track_number:02} - {artist} - {title}.{ext}",
@@ -544,38 +1865,201 @@ still meaningful.
                         "want them to appear. See the README for more info and\n"
                         "examples. Known tags:\n"
                         "   {path}   {title}   {ext}   {track_number}   {album}")
+    parser.add_argument('-u', '--update', action='store_true', default=False,
+                        help="If the zip file already exists, only add songs that aren't in it\n"
+                        "yet or have changed, and take out the ones that aren't in the\n"
+                        "playlist anymore.")
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help="With --update or --sync, also compare the contents of songs\n"
+                        "that look unchanged. (Slower, it has to read everything.)")
+    parser.add_argument('--max-size', action='store', type=parse_size,
+                        default=None, metavar='SIZE',
+                        help="Split the zip file into volumes (TARGET-001.zip, ...) of at\n"
+                        "most SIZE bytes (or 700M, 4G...), each with its own playlist.\n"
+                        "--jobs of them are written at once.")
     parser.add_argument('-w', '--write-playlist-type', action="store",
                         default=None,
                         help="The playlist type to write inside of the zip file.\n"
                         "Defaults to the type of the first playlist passed in.\n"
-                        "Options:\n   none   pls   m3u   \n" # xspf
+                        "Options:\n   none   pls   m3u   xspf\n"
                         "If 'none' then no playlist will be written")
     parser.add_argument('-g', '--graphical', action='store_true',
                         default=False,
                         help="Force using the graphical interface, even if some\n"
                         "arguments are provided.")
-
-    return parser.parse_args()
-
-def main(args):
+    parser.add_argument('--tag-cache', action='store', metavar='PATH',
+                        default=None,
+                        help="Keep the tags read from songs in an SQLite database at PATH\n"
+                        "and reuse them on later runs for files that haven't changed.\n"
+                        "Songs' checksums are kept there too, for zipping them faster.\n"
+                        "(Something like {0})".format(tagcache.DEFAULT_PATH))
+    parser.add_argument('--tag-cache-size', action='store', type=int,
+                        default=tagcache.DEFAULT_MAX_ENTRIES, metavar='N',
+                        help="The most songs to keep in the tag cache. (Default: %(default)s)")
+    parser.add_argument('--dedupe', action='store', choices=('path', 'content'),
+                        default=None,
+                        help="Leave out songs that are already in the list: 'path' compares\n"
+                        "where they are, 'content' compares the files themselves.")
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=1, metavar='N',
+                        help="Find songs and read their tags N at a time. (Default: %(default)s)")
+    parser.add_argument('--processes', action='store_true', default=False,
+                        help="With --jobs, read tags in separate processes instead of threads.")
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        default=[],
+                        help="When adding a directory, only add songs whose path below it\n"
+                        "matches GLOB. Can be given more than once.")
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        default=[],
+                        help="When adding a directory, skip files and directories below it\n"
+                        "that match GLOB. Can be given more than once.")
+    parser.add_argument('--no-progress', action='store_true', default=False,
+                        help="Don't draw a progress bar.")
+    parser.add_argument('--metrics', action='store', metavar='PATH', default=None,
+                        help="At the end, write how many songs and bytes were done, and how\n"
+                        "long each stage of the work took, to PATH as JSON ('-' for\n"
+                        "stdout, if nothing else is going there).")
+    parser.add_argument('-z', '--compression-level', action='store', type=int,
+                        default=zipwriter.DEFAULT_LEVEL, metavar='LEVEL',
+                        help="How hard to compress songs that are worth compressing, 0-9.\n"
+                        "0 stores everything uncompressed. (Default: %(default)s)")
+    parser.add_argument('--compress', action='store', metavar='EXT,EXT...',
+                        default=','.join(CompressionPolicy.DEFLATE),
+                        help="The kinds of files that are worth compressing.\n"
+                        "(Default: %(default)s)")
+
+    args = parser.parse_args()
+    if (args.manifest or args.also_copy) and not args.rename:
+        # they go through Songs.export, which writes everything afresh
+        ignored = [option for option, given in
+                   (('--sync', args.sync),
+                    ('--prune', args.prune),
+                    ('--update', args.update),
+                    ('--verify', args.verify),
+                    ('--max-size', args.max_size),
+                    ('--copy-method',
+                     args.copy_method != transfer.DEFAULT_STRATEGY))
+                   if given]
+        if ignored:
+            parser.error("%s can't be used with --manifest or --also-copy"
+                         % ', '.join(ignored))
+    # JSON written after a zip file (or a report) on stdout spoils it
+    if args.metrics == '-':
+        if args.batch and args.report == '-':
+            parser.error("--metrics - can't go to stdout with the --report")
+        if args.target == '-' and not args.batch:
+            parser.error("--metrics - can't go to stdout with the zip file")
+    return args
+
+def main(args, progress=None):
+    """Do what the command line `args` say.
+
+    `progress`: a `progress.Progress` to report to. By default that's a
+                progress bar, if stderr is a terminal.
+
+    Returns the `Songs` that were exported (or renamed), if any were.
+    Exits with status 1 if any of a `--batch`'s jobs failed, after
+    writing the report.
+    """
+    if progress is None:
+        if sys.stderr.isatty() and not args.no_progress:
+            progress = ProgressBar()
+        else:
+            progress = Progress()
+
+    songs = None
+    failed = 0
+    if args.batch:
+        tag_cache = None
+        if args.tag_cache:
+            tag_cache = TagCache(args.tag_cache, args.tag_cache_size)
+        jobs = batch.load(args.batch)
+        if '-' in (args.report, args.metrics) and \
+                [job for job in jobs if job.get('target') == '-']:
+            raise batch.ManifestError("A job can't zip to stdout when the "
+                                      "report or metrics are going there")
+        try:
+            report = Songs.batch(jobs, args.jobs,
+                                 args.processes, tag_cache,
+                                 CompressionPolicy(args.compress.split(','),
+                                                   args.compression_level),
+                                 progress)
+        finally:
+            if tag_cache is not None:
+                tag_cache.close()
+        batch.write_report(report, args.report)
+        failed = len([job for job in report if job['status'] != 'ok'])
+    elif args.resume_renames:
+        progress.start('rename')
+        try:
+            renamer.resume(args.resume_renames, args.jobs, progress)
+        finally:
+            progress.finish()
+    elif args.rollback_renames:
+        renamer.rollback(args.rollback_renames)
+    else:
+        tag_cache = None
+        if args.tag_cache:
+            tag_cache = TagCache(args.tag_cache, args.tag_cache_size)
+        try:
+            songs = _main(args, tag_cache, progress)
+        finally:
+            if tag_cache is not None:
+                tag_cache.close()
+    if args.metrics:
+        progress.write_metrics(args.metrics)
+    if failed:
+        # not a RuntimeError: the report may have gone to stdout, and
+        # the message mustn't end up after it
+        print >>sys.stderr, "%d of the batch's jobs didn't finish" % failed
+        sys.exit(1)
+    return songs
+
+def _main(args, tag_cache, progress):
     songs = Songs(args.playlist,
-                  export_type=args.write_playlist_type)
-
-    print [str(s) for s in songs.songs] ; exit()
+                  export_type=args.write_playlist_type,
+                  tag_cache=tag_cache,
+                  jobs=args.jobs,
+                  processes=args.processes,
+                  dedupe=args.dedupe,
+                  lazy=True,
+                  include=args.include,
+                  exclude=args.exclude,
+                  progress=progress)
 
     if not args.target and not args.rename:
         target = os.path.splitext(os.path.basename(args.playlist[0]))[0]
         args.target = target
+    if args.target == '-' and args.inner_folder_name is None:
+        args.inner_folder_name = os.path.splitext(
+            os.path.basename(args.playlist[0]))[0]
 
     if not args.format.endswith(".{ext}"):
         args.format += ".{ext}"
 
-    if args.copy:
-        songs.copy_em(args.target, args.format)
+    compression = CompressionPolicy(args.compress.split(','),
+                                    args.compression_level)
+    if (args.manifest or args.also_copy) and not args.rename:
+        if args.copy:
+            songs.export(copy_target=args.target, manifest=args.manifest,
+                         fmt=args.format)
+        else:
+            songs.export(zip_target=args.target, copy_target=args.also_copy,
+                         manifest=args.manifest, fmt=args.format,
+                         inner_dir=args.inner_folder_name,
+                         compression=compression)
+    elif args.copy:
+        summary = songs.copy_em(args.target, args.format, args.copy_method,
+                                sync=args.sync, verify=args.verify,
+                                prune=args.prune)
+        print >>sys.stderr, summary
     elif args.rename:
-        songs.rename_em(args.target, args.format)
+        songs.rename_em(args.target, args.format, args.journal)
     else:
-        songs.zip_em(args.target, args.inner_folder_name, args.format)
+        songs.zip_em(args.target, args.inner_folder_name, args.format,
+                     compression, update=args.update, verify=args.verify,
+                     max_size=args.max_size)
+    return songs
 
 if __name__ == "__main__":
     try:
@@ -585,7 +2069,10 @@ if __name__ == "__main__":
         else:
             import gui
             gui.main(args)
+    # stderr, because stdout can be the zip file (-t -)
     except (KeyboardInterrupt, EOFError):
-        print "\rCaught keyboard interrupt. Giving up without Cleaning up."
+        print >>sys.stderr, "\rCaught keyboard interrupt. Giving up."
+        sys.exit(1)
     except RuntimeError, e:
-        print "Error! Error!: %s" % e
+        print >>sys.stderr, "Error! Error!: %s" % e
+        sys.exit(1)
@@ -0,0 +1,669 @@
+"""A small zip file writer.
+
+`zipfile.ZipFile` insists on compressing every member itself, one at a
+time, which means that it can only ever use one core, and it needs to
+be able to seek around in the file it's writing. `ZipWriter` writes
+archives that `ZipFile` (and everyone else) can read, but will also
+take members that were deflated somewhere else, like in another
+process, and can write to pipes and sockets.
+
+Archives can be as big, and have as many members, as ZIP64 allows. The
+ZIP64 extensions are only used by the members, and archives, that need
+them, and the central directory is packed as each member is finished
+(and kept on disk once it gets big), so writing the millionth member
+costs as much as writing the first.
+
+Stored members whose CRC is already known (or is worked out in one
+quick pass over the file) are written with it in their header, and
+then copied into the archive by the kernel, without ever being read
+into python, wherever the kernel can do that.
+"""
+
+from __future__ import with_statement
+
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from zipfile import (ZipFile, ZIP_STORED, ZIP_DEFLATED, LargeZipFile,
+                     structFileHeader, stringFileHeader,
+                     structCentralDir, stringCentralDir,
+                     structEndArchive, stringEndArchive,
+                     structEndArchive64, stringEndArchive64,
+                     structEndArchive64Locator, stringEndArchive64Locator)
+
+from progress import Progress
+from transfer import Unsupported, copy_fd
+
+CHUNK_SIZE = 1 << 20
+# checksumming is quicker in big pieces
+CRC_CHUNK_SIZE = 8 << 20
+# how much the kernel copies between progress reports
+KERNEL_CHUNK_SIZE = 16 << 20
+DEFAULT_LEVEL = 6
+
+# version 2.0 is what you need for deflate, 4.5 for ZIP64
+VERSION = 20
+ZIP64_VERSION = 45
+# the most a 32 bit size or offset, or the end record's count of
+# members, can hold, and what they're set to when the real number is
+# somewhere in ZIP64
+MAX_32 = 0xffffffff
+MAX_MEMBERS = 0xffff
+# sizes and offsets this big or bigger need ZIP64, and so do this many
+# members or more (a count of MAX_MEMBERS means "look in ZIP64")
+ZIP64_LIMIT = MAX_32
+ZIP64_COUNT_LIMIT = MAX_MEMBERS
+ZIP64_EXTRA = 0x0001
+# how much of the central directory is kept in memory before the rest
+# goes to a temporary file
+DIRECTORY_SPOOL_SIZE = 16 << 20
+# the upper byte of the creating version: Unix, so that external_attr
+# means file permissions
+CREATE_SYSTEM = 3
+UTF8_FLAG = 0x800
+# the crc and sizes are in a data descriptor after the member's data
+DESCRIPTOR_FLAG = 0x08
+stringDataDescriptor = 'PK\x07\x08'
+structDataDescriptor = '<4sLLL'
+structDataDescriptor64 = '<4sLQQ'
+# what an archive costs on top of its members, at most
+END_SIZE = (struct.calcsize(structEndArchive64) +
+            struct.calcsize(structEndArchive64Locator) +
+            struct.calcsize(structEndArchive))
+
+class CompressionPolicy(object):
+    """Decides which members of an archive get deflated, and how hard.
+
+    Audio that's already compressed (mp3, ogg, m4a, flac...) gets
+    nothing out of deflate, so by default only uncompressed audio and
+    the playlists and other text that go along with songs are
+    compressed, and only if they're at least `min_size` bytes.
+
+    >>> policy = CompressionPolicy(levels={'wav': 9})
+    >>> policy.choose('mp3', 5000000)
+    (0, None)
+    >>> policy.choose('wav', 5000000)
+    (8, 9)
+    """
+    DEFLATE = ('wav', 'aif', 'aiff', 'aifc', 'au', 'snd',
+               'pls', 'm3u', 'm3u8', 'xspf', 'cue', 'log', 'txt', 'nfo')
+
+    def __init__(self, deflate=DEFLATE, level=DEFAULT_LEVEL,
+                 min_size=4096, levels=None):
+        """
+        Arguments:
+        `deflate`: the extensions that are worth compressing.
+        `level`: the zlib compression level to use. 0 stores everything.
+        `min_size`: members smaller than this are always stored.
+        `levels`: a dict of extension -> level, for extensions that
+                  should use something other than `level`.
+        """
+        self.deflate = frozenset(ext.lower() for ext in deflate)
+        self.level = level
+        self.min_size = min_size
+        self.levels = dict(levels or ())
+
+    def choose(self, ext, size=None):
+        """Return (compress_type, level) for a `size` byte member
+
+        If `size` is None (it isn't known yet) it's assumed to be big
+        enough to be worth compressing.
+        """
+        ext = ext.lower()
+        if not self.level or ext not in self.deflate or \
+                (size is not None and size < self.min_size):
+            return ZIP_STORED, None
+        return ZIP_DEFLATED, self.levels.get(ext, self.level)
+
+def deflate_file(path, level=DEFAULT_LEVEL):
+    """Return (crc, size, data), `data` being the file at `path` deflated.
+
+    Meant to be run in a worker process, the result can be handed to
+    `ZipWriter.write_deflated`.
+    """
+    crc = size = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    parts = list()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return crc & 0xffffffff, size, ''.join(parts)
+
+def file_crc(path):
+    "Return the CRC32 of the file at `path`, the way zip files store it"
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _fd_crc(fd)
+    finally:
+        os.close(fd)
+
+def _fd_crc(fd, progress=None):
+    "Return the CRC32 of the rest of the file `fd`"
+    if progress is None:
+        progress = Progress()
+    crc = 0
+    while True:
+        with progress.timer('read'):
+            chunk = os.read(fd, CRC_CHUNK_SIZE)
+        if not chunk:
+            break
+        with progress.timer('compress'):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+def member_size(arcname, size, compress_type=ZIP_STORED):
+    """How many bytes, at most, a `size` byte file adds to an archive as
+    `arcname`: its local header, data, data descriptor and central
+    directory entry, with all of their ZIP64 extras.
+
+    Deflated data is allowed to be as much bigger than the file as
+    zlib's `deflateBound` says it can get.
+    """
+    if isinstance(arcname, unicode):
+        arcname = arcname.encode('utf-8')
+    if compress_type == ZIP_DEFLATED:
+        size += (size >> 12) + (size >> 14) + (size >> 25) + 13
+    return (struct.calcsize(structFileHeader) + len(arcname) + 20 + size +
+            struct.calcsize(structDataDescriptor64) +
+            struct.calcsize(structCentralDir) + len(arcname) + 28)
+
+def same_file(info, st):
+    """Could the member `info` have come from the file with stat `st`?
+
+    Compares sizes and modification times, to the two seconds that zip
+    files keep.
+    """
+    return (info.file_size == st.st_size and
+            _dos(info.date_time) == dos_date_time(st.st_mtime))
+
+def seekable(fp):
+    "Can we go back and fix things up in the file-like `fp`?"
+    try:
+        fp.seek(0, os.SEEK_CUR)
+        fp.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+def dos_date_time(timestamp):
+    "Return the (date, time) zip files want for a unix timestamp"
+    t = time.localtime(timestamp)
+    if t[0] < 1980:
+        # zip can't do dates from before 1980
+        t = (1980, 1, 1, 0, 0, 0)
+    return _dos(t)
+
+def _dos(t):
+    return ((t[0] - 1980) << 9 | t[1] << 5 | t[2],
+            t[3] << 11 | t[4] << 5 | t[5] // 2)
+
+class ZipWriter(object):
+    """Write a zip file, one member at a time.
+
+    >>> zw = ZipWriter("songs.zip")
+    >>> with zw.open("songs.m3u", ZIP_DEFLATED) as fh:
+    ...     songs.write_m3u(fh)
+    >>> zw.write("path/to/song.wav", "songs/01 - song.wav", ZIP_DEFLATED)
+    >>> zw.write_deflated("songs/02 - other.wav",
+    ...                   deflate_file("path/to/other.wav"))
+    >>> zw.close()
+
+    If the file it's writing to can't seek (stdout, a pipe, a socket's
+    `makefile('wb')`...) then members that are written without knowing
+    their size and CRC up front get them in a data descriptor after
+    their data, so nothing ever has to be held back.
+
+    Members of 4GB or more need to be written with ZIP64 sizes, which
+    `write` and `write_deflated` work out for themselves, and `open`
+    needs to be told about with its `size`. Otherwise a `LargeZipFile`
+    is raised when the member turns out to be too big.
+    """
+    def __init__(self, target, progress=None):
+        """`target` is a path or a file opened for writing in binary mode
+
+        `progress`: a `progress.Progress` to tell about the time spent
+                    reading, compressing and writing, and the bytes
+                    read by `write`.
+        """
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
+        self._own_fp = isinstance(target, basestring)
+        # the file to delete if we're aborted
+        self.path = None
+        if self._own_fp:
+            self.path = target
+            self.fp = open(target, 'wb')
+        else:
+            self.fp = target
+        self.streaming = not seekable(self.fp)
+        self.offset = 0
+        # the central directory, packed, and how many entries are in it
+        self.directory = tempfile.SpooledTemporaryFile(DIRECTORY_SPOOL_SIZE)
+        self.count = 0
+        self.closed = False
+
+    @classmethod
+    def update(cls, path, keep, progress=None):
+        """Open the zip file at `path` to add more members to it.
+
+        `keep(info)` is called with the `ZipInfo` of each member already
+        in the archive, and says whether it should stay. The ones that
+        shouldn't are removed, and the members after them are moved
+        down to fill in the gap, so only the part of the archive after
+        the first removed member gets rewritten.
+
+        Returns a `ZipWriter` that will write after the last kept
+        member and knows about all of them, and reports to `progress`.
+
+        If `keep` raises the archive is left as it was. If moving the
+        members down fails the archive is ended after the ones that
+        had been moved, so it's still one that can be read (and
+        updated again), without the rest.
+        """
+        zf = ZipFile(path)
+        try:
+            infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+            end = zf.start_dir
+        finally:
+            zf.close()
+        # all of them before anything is moved
+        kept = [keep(info) for info in infos]
+
+        fp = open(path, 'r+b')
+        zw = cls(fp, progress)
+        zw._own_fp = True
+        header_offset = 0
+        try:
+            for i, info in enumerate(infos):
+                # a member runs from its header up to the next one,
+                # which takes care of data descriptors and anything
+                # else that's after its data
+                start = info.header_offset
+                if i + 1 < len(infos):
+                    stop = infos[i + 1].header_offset
+                else:
+                    stop = end
+                if not kept[i]:
+                    continue
+                header_offset = zw.offset
+                if start != zw.offset:
+                    zw._move(start, stop - start)
+                else:
+                    zw.offset = stop
+                arcname = info.filename
+                if isinstance(arcname, unicode):
+                    arcname = arcname.encode('utf-8')
+                dosdate, dostime = _dos(info.date_time)
+                zw._add_entry([arcname, info.flag_bits, info.compress_type,
+                               dostime, dosdate, info.CRC,
+                               info.compress_size, info.file_size,
+                               info.external_attr, header_offset])
+                header_offset = zw.offset
+            fp.seek(zw.offset)
+            fp.truncate()
+        except BaseException:
+            exc_info = sys.exc_info()
+            try:
+                # drop whatever was half moved, and end the archive
+                # after the members that are all there
+                zw.offset = header_offset
+                fp.seek(zw.offset)
+                fp.truncate()
+                zw.close()
+            except Exception:
+                fp.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return zw
+
+    def _move(self, start, length):
+        "Copy `length` bytes from `start` down to where we're writing"
+        copied = 0
+        while copied < length:
+            self.fp.seek(start + copied)
+            chunk = self.fp.read(min(CHUNK_SIZE, length - copied))
+            if not chunk:
+                break
+            self.fp.seek(self.offset)
+            self._write(chunk)
+            copied += len(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def _start_member(self, arcname, compress_type, mtime, mode,
+                      crc=None, compress_size=0, file_size=0, zip64=False):
+        """Write a local header.
+
+        If `crc` is None the sizes and crc aren't known yet, and will be
+        filled in by `_finish_member`, which also adds the member to the
+        central directory. `zip64` says whether they'll need ZIP64.
+        """
+        flags = 0
+        finished = crc is not None
+        if not finished:
+            crc = 0
+            if self.streaming:
+                flags |= DESCRIPTOR_FLAG
+        else:
+            zip64 = compress_size >= ZIP64_LIMIT or file_size >= ZIP64_LIMIT
+        if isinstance(arcname, unicode):
+            arcname = arcname.encode('utf-8')
+            flags |= UTF8_FLAG
+        dosdate, dostime = dos_date_time(mtime)
+        entry = [arcname, flags, compress_type, dostime, dosdate,
+                 crc, compress_size, file_size,
+                 (mode & 0xFFFF) << 16, self.offset, zip64]
+        version = VERSION
+        extra = ''
+        if zip64:
+            # the sizes go in the extra field instead
+            version = ZIP64_VERSION
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA, 16,
+                                file_size, compress_size)
+            compress_size = file_size = MAX_32
+        self._write(struct.pack(structFileHeader, stringFileHeader,
+                                version, 0, flags, compress_type,
+                                dostime, dosdate, crc,
+                                compress_size, file_size,
+                                len(arcname), len(extra)))
+        self._write(arcname)
+        self._write(extra)
+        if finished:
+            self._add_entry(entry)
+        return entry
+
+    def _finish_member(self, entry, crc, compress_size, file_size):
+        """Go back and fill in the sizes and CRC of the local header
+
+        Or, if we can't go back, write them in a data descriptor. Then
+        the member goes in the central directory.
+        """
+        arcname, zip64, header_offset = entry[0], entry[10], entry[9]
+        if not zip64 and (compress_size >= ZIP64_LIMIT or
+                          file_size >= ZIP64_LIMIT):
+            raise LargeZipFile("%s turned out to need ZIP64, which it "
+                               "wasn't started with" % arcname)
+        entry[5:8] = crc, compress_size, file_size
+        if self.streaming:
+            if zip64:
+                self._write(struct.pack(structDataDescriptor64,
+                                        stringDataDescriptor,
+                                        crc, compress_size, file_size))
+            else:
+                self._write(struct.pack(structDataDescriptor,
+                                        stringDataDescriptor,
+                                        crc, compress_size, file_size))
+            self.fp.flush()
+        else:
+            self.fp.seek(header_offset + 14)
+            if zip64:
+                self.fp.write(struct.pack("<L", crc))
+                self.fp.seek(header_offset +
+                             struct.calcsize(structFileHeader) +
+                             len(arcname) + 4)
+                self.fp.write(struct.pack("<QQ", file_size, compress_size))
+            else:
+                self.fp.write(struct.pack("<LLL", crc, compress_size,
+                                          file_size))
+            self.fp.seek(self.offset)
+        self._add_entry(entry)
+
+    def _add_entry(self, entry):
+        """Pack the central directory record for `entry`, a finished
+        member
+        """
+        (arcname, flags, compress_type, dostime, dosdate, crc,
+         compress_size, file_size, external_attr, header_offset) = entry[:10]
+        # whichever of these are too big go in a ZIP64 extra field
+        # instead, in this order
+        large = list()
+        if file_size >= ZIP64_LIMIT:
+            large.append(file_size)
+            file_size = MAX_32
+        if compress_size >= ZIP64_LIMIT:
+            large.append(compress_size)
+            compress_size = MAX_32
+        if header_offset >= ZIP64_LIMIT:
+            large.append(header_offset)
+            header_offset = MAX_32
+        version = VERSION
+        extra = ''
+        if large:
+            version = ZIP64_VERSION
+            extra = struct.pack('<HH%dQ' % len(large), ZIP64_EXTRA,
+                                8 * len(large), *large)
+        self.directory.write(struct.pack(structCentralDir, stringCentralDir,
+                                         version, CREATE_SYSTEM, version, 0,
+                                         flags, compress_type,
+                                         dostime, dosdate, crc,
+                                         compress_size, file_size,
+                                         len(arcname), len(extra), 0, 0, 0,
+                                         external_attr, header_offset))
+        self.directory.write(arcname)
+        self.directory.write(extra)
+        self.count += 1
+
+    def open(self, arcname, compress_type=ZIP_STORED, level=DEFAULT_LEVEL,
+             mtime=None, mode=0644, size=None):
+        """Return a file-like object that writes the member `arcname`.
+
+        Nothing else can be written to the archive until it's closed.
+
+        `size`: about how many bytes are going to be written, if it's
+                known, so that members that might get to 4GB are
+                written with ZIP64.
+        """
+        if mtime is None:
+            mtime = time.time()
+        # deflating can make things a little bigger
+        zip64 = size is not None and size * 1.05 >= ZIP64_LIMIT
+        entry = self._start_member(arcname, compress_type, mtime, mode,
+                                   zip64=zip64)
+        return _MemberWriter(self, entry, compress_type, level)
+
+    def write(self, path, arcname, compress_type=ZIP_STORED,
+              level=DEFAULT_LEVEL, crc=None, st=None):
+        """Add the file at `path` to the archive as `arcname`, and return
+        its CRC32.
+
+        Stored members are written with their size and CRC in their
+        header, and then copied by the kernel (see `transfer.copy_fd`)
+        if it can.
+
+        `crc`: the file's CRC32, if it's known already (from a cache,
+               say), otherwise it's read first to work it out.
+        `st`: `os.stat(path)`, if you've already got it.
+        """
+        if st is None:
+            st = os.stat(path)
+        if compress_type == ZIP_STORED:
+            return self._write_stored(path, arcname, st, crc)
+        timer = self.progress.timer
+        with open(path, 'rb') as fh:
+            with self.open(arcname, compress_type, level,
+                           st.st_mtime, st.st_mode, st.st_size) as member:
+                while True:
+                    with timer('read'):
+                        chunk = fh.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    self.progress.advance(size=len(chunk))
+        return member.crc & 0xffffffff
+
+    def _write_stored(self, path, arcname, st, crc):
+        "`write` a member without compressing it"
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if crc is None:
+                crc = _fd_crc(fd, self.progress)
+                os.lseek(fd, 0, os.SEEK_SET)
+            self._start_member(arcname, ZIP_STORED, st.st_mtime, st.st_mode,
+                               crc, st.st_size, st.st_size)
+            copied = self._copy_from(fd, st.st_size)
+        finally:
+            os.close(fd)
+        if copied != st.st_size:
+            raise IOError("%s changed size while it was being zipped" % path)
+        return crc
+
+    def _copy_from(self, fd, size):
+        """Copy `size` bytes from the file `fd` onto the end of the
+        archive, in the kernel if it can. Returns how many there were.
+        """
+        timer = self.progress.timer
+        copied = 0
+        try:
+            target = self.fp.fileno()
+        except (AttributeError, IOError, ValueError):
+            target = None
+        if target is not None:
+            # what's buffered goes first
+            self.fp.flush()
+            try:
+                while copied < size:
+                    with timer('write'):
+                        n = copy_fd(fd, target,
+                                    min(KERNEL_CHUNK_SIZE, size - copied))
+                    if not n:
+                        break
+                    copied += n
+                    self.offset += n
+                    self.progress.advance(size=n)
+            except Unsupported:
+                pass
+            finally:
+                # the file object doesn't know the kernel has moved on
+                if not self.streaming:
+                    self.fp.seek(self.offset)
+            if copied == size:
+                return copied
+        # whatever the kernel couldn't do
+        while copied < size:
+            with timer('read'):
+                chunk = os.read(fd, min(CHUNK_SIZE, size - copied))
+            if not chunk:
+                break
+            with timer('write'):
+                self._write(chunk)
+            copied += len(chunk)
+            self.progress.advance(size=len(chunk))
+        return copied
+
+    def write_deflated(self, arcname, deflated, mtime=None, mode=0644):
+        """Add a member that has already been compressed.
+
+        `deflated`: a (crc, size, data) tuple like `deflate_file`
+                    returns.
+        """
+        crc, file_size, data = deflated
+        if mtime is None:
+            mtime = time.time()
+        self._start_member(arcname, ZIP_DEFLATED, mtime, mode,
+                           crc, len(data), file_size)
+        with self.progress.timer('write'):
+            self._write(data)
+
+    def close(self):
+        "Write the central directory, and close the file if we opened it"
+        if self.closed:
+            return
+        self.closed = True
+        start = self.offset
+        self.directory.seek(0)
+        with self.progress.timer('write'):
+            while True:
+                chunk = self.directory.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._write(chunk)
+        self.directory.close()
+        count, size = self.count, self.offset - start
+        if count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or \
+                start >= ZIP64_LIMIT:
+            end64 = self.offset
+            self._write(struct.pack(structEndArchive64, stringEndArchive64,
+                                    struct.calcsize(structEndArchive64) - 12,
+                                    ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                    count, count, size, start))
+            self._write(struct.pack(structEndArchive64Locator,
+                                    stringEndArchive64Locator, 0, end64, 1))
+            # and the real numbers are in there
+            count = min(count, MAX_MEMBERS)
+            size = min(size, MAX_32)
+            start = min(start, MAX_32)
+        self._write(struct.pack(structEndArchive, stringEndArchive,
+                                0, 0, count, count, size, start, 0))
+        self.fp.flush()
+        if self._own_fp:
+            self.fp.close()
+
+    def abort(self):
+        """Stop without finishing the archive.
+
+        If we created the file it's deleted, otherwise it's left as it
+        is, which isn't a zip file anyone can read.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.directory.close()
+        if self._own_fp:
+            self.fp.close()
+            if self.path is not None:
+                os.remove(self.path)
+
+class _MemberWriter(object):
+    "What `ZipWriter.open` returns"
+    def __init__(self, zw, entry, compress_type, level):
+        self.zw = zw
+        self.entry = entry
+        self.start = zw.offset
+        self.crc = self.size = 0
+        self.compressor = None
+        if compress_type == ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(level or DEFAULT_LEVEL,
+                                               zlib.DEFLATED, -15)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        timer = self.zw.progress.timer
+        with timer('compress'):
+            self.size += len(data)
+            self.crc = zlib.crc32(data, self.crc)
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+        with timer('write'):
+            self.zw._write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.compressor is not None:
+            self.zw._write(self.compressor.flush())
+        self.zw._finish_member(self.entry, self.crc & 0xffffffff,
+                               self.zw.offset - self.start, self.size)